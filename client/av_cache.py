@@ -0,0 +1,148 @@
+import copy
+import hashlib
+import os
+import pickle
+import sqlite3
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+"""
+Caches for decoded app-version entries (see WebdetectLevelDb.parse_app_version_value), so repeated scans
+skip LevelDB reads and parsing for popular app-versions (WordPress cores, akismet, ...).
+
+Both caches are keyed by app-version id and bounded by a byte budget (size of raw LevelDB values), least recently
+used entries are evicted first. Entries are returned as copies, as WebdetectClient.process sets :used_cs on them.
+"""
+
+# number of reads of SqliteAppVersionCache whose LRU updates are written by one transaction
+TOUCH_BATCH_SIZE = 1024
+
+
+# identity of webdetect LevelDB contents: table files are immutable (compaction writes new files),
+# so their names and sizes change whenever DB contents change; not yet compacted writes live in non-empty logs
+def leveldb_identity(path_to_db: str) -> str:
+    files = []
+    for name in sorted(os.listdir(path_to_db)):
+        size = os.path.getsize(os.path.join(path_to_db, name))
+        if name.endswith('.ldb') or name.endswith('.sst') or (name.endswith('.log') and size > 0):
+            files.append('%s:%d' % (name, size))
+    return hashlib.sha256('\n'.join(files).encode('utf8')).hexdigest()
+
+
+class MemoryAppVersionCache:
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.entries: OrderedDict = OrderedDict()
+        self.db_identity: Optional[str] = None
+
+    # drops all entries if cache was filled from another DB
+    def bind(self, db_identity: str):
+        if self.db_identity != db_identity:
+            self.entries.clear()
+            self.used_bytes = 0
+            self.db_identity = db_identity
+
+    def get(self, av: bytes):
+        found: Optional[Tuple[object, int]] = self.entries.get(av)
+        if found is None:
+            return None
+        self.entries.move_to_end(av)
+        return copy.copy(found[0])
+
+    def put(self, av: bytes, entry, size: int):
+        if size > self.max_bytes:
+            return
+        previous = self.entries.pop(av, None)
+        if previous is not None:
+            self.used_bytes -= previous[1]
+        self.entries[av] = (copy.copy(entry), size)
+        self.used_bytes += size
+        while self.used_bytes > self.max_bytes:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.used_bytes -= evicted_size
+
+    def close(self):
+        pass
+
+
+class SqliteAppVersionCache:
+    # on-disk cache shared across scans (and processes); entries of other DB identities are dropped on bind
+    # get() only reads: LRU updates of read entries are kept in memory and written (and committed) in batches,
+    # so no write transaction is left open between reads and other processes can put() meanwhile
+
+    def __init__(self, path: str, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS app_versions ('
+                          'db TEXT NOT NULL, av BLOB NOT NULL, value BLOB NOT NULL, '
+                          'size INTEGER NOT NULL, used INTEGER NOT NULL, PRIMARY KEY (db, av))')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS app_versions_used ON app_versions (used)')
+        self.conn.commit()
+        self.db_identity: Optional[str] = None
+        self.clock = 0
+        self.touched: Dict[bytes, int] = {}
+
+    def bind(self, db_identity: str):
+        if self.db_identity == db_identity:
+            return
+        self.touched.clear()
+        self.conn.execute('DELETE FROM app_versions WHERE db != ?', (db_identity,))
+        self.conn.commit()
+        self.db_identity = db_identity
+        self.clock = self.conn.execute('SELECT COALESCE(MAX(used), 0) FROM app_versions').fetchone()[0]
+
+    def tick(self) -> int:
+        self.clock += 1
+        return self.clock
+
+    def get(self, av: bytes):
+        row = self.conn.execute('SELECT value FROM app_versions WHERE db = ? AND av = ?',
+                                (self.db_identity, av)).fetchone()
+        if row is None:
+            return None
+        self.touched[av] = self.tick()
+        if len(self.touched) >= TOUCH_BATCH_SIZE:
+            self.write_touched()
+            self.conn.commit()
+        return pickle.loads(row[0])
+
+    # private; writes pending LRU updates, caller commits
+    def write_touched(self):
+        if self.touched:
+            self.conn.executemany('UPDATE app_versions SET used = ? WHERE db = ? AND av = ?',
+                                  ((used, self.db_identity, av) for av, used in self.touched.items()))
+            self.touched.clear()
+
+    def put(self, av: bytes, entry, size: int):
+        if size > self.max_bytes:
+            return
+        # other processes may put into the same file, so its size and LRU clock are read within the write transaction
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            # recently read entries must not be evicted as least recently used ones
+            self.write_touched()
+            last_used = self.conn.execute('SELECT COALESCE(MAX(used), 0) FROM app_versions WHERE db = ?',
+                                          (self.db_identity,)).fetchone()[0]
+            self.clock = max(self.clock, last_used)
+            self.conn.execute('INSERT OR REPLACE INTO app_versions (db, av, value, size, used) VALUES (?, ?, ?, ?, ?)',
+                              (self.db_identity, av, pickle.dumps(entry, pickle.HIGHEST_PROTOCOL), size, self.tick()))
+            used_bytes = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM app_versions WHERE db = ?',
+                                           (self.db_identity,)).fetchone()[0]
+            while used_bytes > self.max_bytes:
+                evicted = self.conn.execute('SELECT av, size FROM app_versions WHERE db = ? ORDER BY used LIMIT 1',
+                                            (self.db_identity,)).fetchone()
+                if evicted is None:
+                    break
+                self.conn.execute('DELETE FROM app_versions WHERE db = ? AND av = ?', (self.db_identity, evicted[0]))
+                used_bytes -= evicted[1]
+            self.conn.commit()
+        except:
+            self.conn.rollback()
+            raise
+
+    def close(self):
+        self.write_touched()
+        self.conn.commit()
+        self.conn.close()
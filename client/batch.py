@@ -0,0 +1,119 @@
+import copy
+import sys
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from instrumentation import NULL_INSTRUMENTATION
+from path_index import rapidscan_key_to_path
+from prefilter import ChecksumFilter
+from webdetect import AVE_Path, AppVersionEntry, WebdetectClient, detected_to_structure, open_checksum_filter, \
+    open_webdetect_db, read_rapidscan, webdetect_db_identity
+
+"""
+Batch detection of many roots (i.e. home directories of a server, one rapidscan DB per root) with a single lookup
+pass: identical core and plugin files are present in almost every root, so checksums are deduplicated across all
+roots first and each distinct checksum is looked up and each found app-version is decoded once.
+Lookup cost scales with the number of distinct files instead of the total one.
+
+Then, per root, found checksums of the root are selected from shared lookup results and matching (process()),
+find_path and find_structure are run on them. process() marks matched AppVersionEntry objects with :used_cs,
+so each root gets its own shallow copies of app-version entries; everything else is shared.
+
+Each rapidscan DB is read twice: for distinct checksums and for its own found checksums with paths; the only state
+kept across roots is the set of distinct checksums (only those which pass the checksum filter, if it's given)
+and lookup results.
+
+python3 batch.py <path to webdetect leveldb or snapshot> <path to rapidscan> [<path to rapidscan> ...]
+"""
+
+# root name -> function returning new iterator over rapidscan (key, value) entries of the root
+RapidscanSources = Dict[str, Callable[[], Iterable[Tuple[bytes, bytes]]]]
+
+
+# private; (key, checksum) of first occurrence of each distinct checksum across all :sources
+def distinct_checksums(sources: RapidscanSources, checksum_filter: Optional[ChecksumFilter],
+                       instrumentation) -> Iterable[Tuple[bytes, bytes]]:
+    seen: Set[bytes] = set()
+    total = 0
+    for entries in sources.values():
+        for (k, v) in entries():
+            total += 1
+            cs = v[9:][:32]
+            if cs in seen or (checksum_filter is not None and not checksum_filter.might_contain(cs)):
+                continue
+            seen.add(cs)
+            yield k, cs
+    instrumentation.count('batch_local_checksums', total)
+    instrumentation.count('batch_distinct_checksums', len(seen))
+
+
+# private; client for one root over shared lookup results of :shared
+def root_client(shared: WebdetectClient, found_entries: List[Tuple[bytes, bytes]]) -> WebdetectClient:
+    found_avs: Dict[bytes, Set[bytes]] = {}
+    checksum_to_ldb_key: Dict[bytes, bytes] = {}
+    for (k, v) in found_entries:
+        cs = v[9:][:32]
+        found_avs.setdefault(shared.checksums_cache[cs][0], set()).add(cs)
+        checksum_to_ldb_key[cs] = k
+    app_versions_cache: Dict[bytes, AppVersionEntry] = {av: copy.copy(shared.app_versions_cache[av])
+                                                        for av in found_avs}
+    return WebdetectClient.from_state(found_avs, shared.checksums_cache, app_versions_cache, checksum_to_ldb_key,
+                                      shared.checksums_bound, shared.instrumentation)
+
+
+# :webdetect_db - opened webdetect DB (see open_webdetect_db)
+# :sources - rapidscan entries per root, each function is called twice
+# :checksum_filter - optional ChecksumFilter (see prefilter.py), ruled out checksums are not kept nor looked up
+# returns structure (as rapidscan_db_to_structure) per root
+def detect_batch(webdetect_db,
+                 sources: RapidscanSources,
+                 av_cache=None,
+                 checksum_filter: Optional[ChecksumFilter] = None,
+                 key_to_path: Callable[[bytes], str] = rapidscan_key_to_path,
+                 instrumentation=None) -> Dict[str, Dict[AVE_Path, List[AVE_Path]]]:
+    if instrumentation is None:
+        instrumentation = NULL_INSTRUMENTATION
+    shared = WebdetectClient(get_by_key=webdetect_db.get_by_key,
+                             parse_checksum_value=webdetect_db.parse_checksum_value,
+                             parse_app_version_value=webdetect_db.parse_app_version_value,
+                             local_checksums=distinct_checksums(sources, checksum_filter, instrumentation),
+                             checksums_bound=0.5,
+                             get_by_keys=webdetect_db.get_by_keys,
+                             av_cache=av_cache,
+                             instrumentation=instrumentation)
+    found = shared.checksums_cache
+    result: Dict[str, Dict[AVE_Path, List[AVE_Path]]] = {}
+    for root, entries in sources.items():
+        with instrumentation.stage('root_checksums'):
+            found_entries = [(k, v) for (k, v) in entries() if v[9:][:32] in found]
+        client = root_client(shared, found_entries)
+        result[root] = detected_to_structure(client.process(), client, found_entries, key_to_path)
+    return result
+
+
+# :path_to_webdetect_leveldb - webdetect LevelDB or its snapshot (see snapshot.py)
+# :paths_to_rapidscan - rapidscan LevelDB or file per root, roots in result are named by these paths
+# other arguments are the same as of webdetect()
+def webdetect_batch(path_to_webdetect_leveldb: str,
+                    paths_to_rapidscan: List[str],
+                    av_cache=None,
+                    path_to_filter: Optional[str] = None,
+                    key_to_path: Callable[[bytes], str] = rapidscan_key_to_path,
+                    instrumentation=None) -> Dict[str, Dict[AVE_Path, List[AVE_Path]]]:
+    sources: RapidscanSources = {path: (lambda path=path: read_rapidscan(path)) for path in paths_to_rapidscan}
+    if av_cache is not None:
+        av_cache.bind(webdetect_db_identity(path_to_webdetect_leveldb))
+    checksum_filter = open_checksum_filter(path_to_filter, path_to_webdetect_leveldb, instrumentation)
+    webdetect_db = open_webdetect_db(path_to_webdetect_leveldb)
+    try:
+        return detect_batch(webdetect_db, sources, av_cache, checksum_filter, key_to_path, instrumentation)
+    finally:
+        webdetect_db.db.close()
+        if checksum_filter is not None:
+            checksum_filter.close()
+
+
+if __name__ == '__main__':
+    from webdetect_client import print_structure
+    for path_to_rapidscan, structure in webdetect_batch(sys.argv[1], sys.argv[2:]).items():
+        print("# %s" % path_to_rapidscan)
+        print_structure(structure)
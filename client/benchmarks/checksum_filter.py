@@ -0,0 +1,77 @@
+#!/usr/bin/python
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from prefilter import ChecksumFilter, build_filter_from_keys, DEFAULT_BITS_PER_KEY
+from synthetic import webdetect_db, checksum, write_leveldb
+from webdetect import DEFAULT_CHUNK_SIZE, WebdetectLevelDb
+
+"""
+Measures false-positive rate of checksum filter (prefilter.py) on synthetic webdetect DB and time of lookups in
+LevelDB (written to temp directory) with and without it: per-key get_by_key and batched get_by_keys (chunks of
+DEFAULT_CHUNK_SIZE, as WebdetectClient looks up local checksums), for absent checksums only and for a host-like mix
+where 1 of HOST_PRESENT_EACH checksums is in DB.
+
+python3 ./client/benchmarks/checksum_filter.py [app-versions count] [bits per key]
+"""
+
+HOST_PRESENT_EACH = 5
+
+
+def timed(fn, keys):
+    started = time.perf_counter()
+    for key in keys:
+        fn(key)
+    return time.perf_counter() - started
+
+
+def timed_batches(fn, keys, chunk_size=DEFAULT_CHUNK_SIZE):
+    started = time.perf_counter()
+    for start in range(0, len(keys), chunk_size):
+        fn(keys[start:start + chunk_size])
+    return time.perf_counter() - started
+
+
+def main(avs: int, bits_per_key: int):
+    db, checksums = webdetect_db(avs=avs, checksums_per_av=200)
+    absent = [checksum(1, i) for i in range(200000)]
+    with tempfile.TemporaryDirectory() as tmp:
+        path_to_filter = os.path.join(tmp, 'filter')
+        build_filter_from_keys(db.keys(), len(checksums), path_to_filter, 'synthetic', bits_per_key)
+        checksum_filter = ChecksumFilter(path_to_filter)
+
+        false_positives = sum(1 for cs in absent if checksum_filter.might_contain(cs))
+        if not all(checksum_filter.might_contain(cs) for cs in checksums):
+            raise Exception("filter has false negatives")
+        print('%d checksums in DB, filter size %.1f KiB, %d bits per key, %d hash functions' % (
+            len(checksums), checksum_filter.bits / 8 / 1024, bits_per_key, checksum_filter.hashes))
+        print('false positives: %d of %d absent checksums (%.3f%%)' % (
+            false_positives, len(absent), 100.0 * false_positives / len(absent)))
+
+        path_to_db = os.path.join(tmp, 'db')
+        write_leveldb(db.items(), path_to_db)
+        leveldb = WebdetectLevelDb(path_to_db)
+        get_by_key = leveldb.get_by_key
+        get_by_keys = leveldb.get_by_keys
+        host = [cs if i % HOST_PRESENT_EACH else checksums[i % len(checksums)] for i, cs in enumerate(absent)]
+        for name, keys in (('absent', absent), ('host', host)):
+            filter_only = timed(checksum_filter.might_contain, keys)
+            plain = timed(get_by_key, keys)
+            filtered = timed(checksum_filter.filtered_get_by_key(get_by_key), keys)
+            batched = timed_batches(get_by_keys, keys)
+            batched_filtered = timed_batches(checksum_filter.filtered_get_by_keys(get_by_keys), keys)
+            print('%s checksums: get_by_key %.0f ns/key, with filter %.0f ns/key; get_by_keys %.0f ns/key, '
+                  'with filter %.0f ns/key (x%.2f); filter check %.0f ns/key' % (
+                      name, plain * 1e9 / len(keys), filtered * 1e9 / len(keys), batched * 1e9 / len(keys),
+                      batched_filtered * 1e9 / len(keys), batched / batched_filtered, filter_only * 1e9 / len(keys)))
+        leveldb.db.close()
+        checksum_filter.close()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000,
+         int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_BITS_PER_KEY)
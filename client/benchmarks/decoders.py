@@ -0,0 +1,117 @@
+#!/usr/bin/python
+import os
+import random
+import struct
+import sys
+import timeit
+from typing import List, Tuple
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from webdetect import AppVersion, AppVersionEntry, WebdetectLevelDb, BARRIER_BYTE, BARRIER_SIGNED, BARRIER_UNSIGNED
+
+"""
+Micro-benchmark of WebdetectLevelDb.parse_checksum_value/parse_app_version_value against previous byte-by-byte
+decoders on synthetic values. Outputs of both implementations are compared before timing.
+
+python3 ./client/benchmarks/decoders.py [values count]
+"""
+
+
+# previous implementation of WebdetectLevelDb.parse_checksum_value
+def parse_checksum_value_bytewise(value: bytes) -> Tuple[bytes, List[bytes], bytes]:
+    ids = list()
+    barrier = None
+    for i in range(0, len(value), 4):
+        if value[i] == BARRIER_UNSIGNED or value[i] == BARRIER_SIGNED:
+            barrier = i
+            break
+    if barrier is None:
+        raise Exception("db is invalid")
+    for i in range(0, barrier, 4):
+        ids.append(value[i:(i + 4)])
+    return ids[0], ids[1:], value[barrier + 1:]
+
+
+# previous implementation of WebdetectLevelDb.parse_app_version_value
+def parse_app_version_value_bytewise(value: bytes) -> AppVersionEntry:
+    indices: List[int] = []
+    list_end_idx = None
+    prev_byte = -1
+    for idx in range(len(value)):
+        byte = value[idx]
+        if byte == 0:
+            if prev_byte == byte:
+                list_end_idx = idx
+                break
+            indices.append(idx)
+        prev_byte = byte
+    if list_end_idx is None:
+        raise Exception("db is invalid")
+    strings: List[str] = []
+    previous_index = 0
+    for index in indices:
+        strings.append(value[previous_index:index].decode("utf8"))
+        previous_index = index + 1
+    if len(strings) % 2 != 0:
+        raise Exception("db is invalid")
+    avs = [AppVersion(strings[index], strings[index + 1]) for index in range(0, len(strings), 2)]
+    total: int = value[list_end_idx + 1]
+    impl: List[bytes] = []
+    for i in range(list_end_idx + 2, len(value), 4):
+        impl.append(value[i:(i + 4)])
+    return AppVersionEntry(avs, impl, total)
+
+
+def av_id(rnd: random.Random) -> bytes:
+    return struct.pack('>I', rnd.randrange(1, 2 ** 24))
+
+
+def synthetic_checksum_value(rnd: random.Random) -> bytes:
+    depends_on = [av_id(rnd) for _ in range(rnd.choice([0, 0, 0, 1, 2, 8]))]
+    depths = bytes(rnd.randrange(0, 8) for _ in range(rnd.randrange(1, 4)))
+    return av_id(rnd) + b''.join(depends_on) + BARRIER_BYTE + depths
+
+
+def synthetic_app_version_value(rnd: random.Random) -> bytes:
+    strings = []
+    for _ in range(rnd.choice([1, 1, 1, 2, 5])):
+        strings.append('wp.p%s' % ''.join(rnd.choice('abcdefghijklmnopqrstuvwxyz-') for _ in range(rnd.randrange(4, 30))))
+        strings.append('%d.%d.%d' % (rnd.randrange(10), rnd.randrange(10), rnd.randrange(100)))
+    implies = [av_id(rnd) for _ in range(rnd.choice([0, 0, 1, 3]))]
+    return b''.join(x.encode('utf8') + b'\0' for x in strings) + b'\0' + bytes([rnd.randrange(256)]) + b''.join(implies)
+
+
+def same_entry(a: AppVersionEntry, b: AppVersionEntry) -> bool:
+    return [(x.app, x.version) for x in a.av] == [(x.app, x.version) for x in b.av] and \
+           a.impl == b.impl and a.total == b.total
+
+
+def bench(name, fn, values, repeat=5):
+    best = min(timeit.repeat(lambda: [fn(v) for v in values], number=1, repeat=repeat))
+    print('%-40s %10.1f ns/value' % (name, best * 1e9 / len(values)))
+    return best
+
+
+def main(count: int):
+    rnd = random.Random(42)
+    checksum_values = [synthetic_checksum_value(rnd) for _ in range(count)]
+    app_version_values = [synthetic_app_version_value(rnd) for _ in range(count)]
+
+    for v in checksum_values:
+        if parse_checksum_value_bytewise(v) != WebdetectLevelDb.parse_checksum_value(v):
+            raise Exception("parse_checksum_value output differs for %s" % v.hex())
+    for v in app_version_values:
+        if not same_entry(parse_app_version_value_bytewise(v), WebdetectLevelDb.parse_app_version_value(v)):
+            raise Exception("parse_app_version_value output differs for %s" % v.hex())
+
+    old = bench('parse_checksum_value (bytewise)', parse_checksum_value_bytewise, checksum_values)
+    new = bench('parse_checksum_value', WebdetectLevelDb.parse_checksum_value, checksum_values)
+    print('speedup: %.2fx' % (old / new))
+    old = bench('parse_app_version_value (bytewise)', parse_app_version_value_bytewise, app_version_values)
+    new = bench('parse_app_version_value', WebdetectLevelDb.parse_app_version_value, app_version_values)
+    print('speedup: %.2fx' % (old / new))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,46 @@
+#!/usr/bin/python
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from webdetect import WebdetectClient, CompactWebdetectClient, WebdetectLevelDb
+from synthetic import webdetect_db, local_checksums
+
+"""
+Compares peak memory (tracemalloc) and time of WebdetectClient and CompactWebdetectClient lookup + process()
+on synthetic webdetect DB; results of both engines are compared.
+
+python3 ./client/benchmarks/engine_memory.py [app-versions count]
+"""
+
+
+def run(client_type, db, local):
+    tracemalloc.start()
+    started = time.perf_counter()
+    client = client_type(get_by_key=db.get,
+                         parse_checksum_value=WebdetectLevelDb.parse_checksum_value,
+                         parse_app_version_value=WebdetectLevelDb.parse_app_version_value,
+                         local_checksums=local,
+                         checksums_bound=0.5)
+    result = client.process()
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('%-24s peak %8.1f MiB, %6.2f s, %d app-versions' % (client_type.__name__, peak / 2 ** 20, elapsed,
+                                                                  len(result)))
+    return set((str(x), frozenset(x.used_cs)) for x in result)
+
+
+def main(avs: int):
+    db, checksums = webdetect_db(avs=avs, checksums_per_av=200, depends_on_depth=2, implies_fan_out=3)
+    local = local_checksums(checksums, present=0.7, absent=len(checksums) // 2)
+    print('%d app-versions, %d checksums in DB, %d local checksums' % (avs, len(checksums), len(local)))
+    if run(WebdetectClient, db, local) != run(CompactWebdetectClient, db, local):
+        raise Exception("engines results differ")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
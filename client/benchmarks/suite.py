@@ -0,0 +1,250 @@
+#!/usr/bin/python
+import argparse
+import gc
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional, Tuple
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utils'))
+
+from path_index import build_path_index
+from snapshot import write_snapshot
+from synthetic import host_files, webdetect_db, write_leveldb, write_rapidscan, write_tree
+from webdetect import AVE_Path, AppVersionEntry, WebdetectClient, WebdetectLevelDb, open_webdetect_db, read_rapidscan, \
+    webdetect
+
+"""
+Benchmark suite of webdetect client hot paths on generated data: synthetic webdetect DB (see synthetic.py) written
+as LevelDB (or snapshot), rapidscan DB/file of a host with part of its app-versions installed and, optionally,
+the same host as directory tree for path_scanner.py.
+
+Each stage is run --repeat times (setup of a run, i.e. creating a client to be processed, is not timed), then once
+more under tracemalloc for peak memory. Report is JSON (stdout or --output): per stage wall time percentiles over
+runs, items processed per run and throughput, peak traced memory; summary table is printed to stderr.
+With --compare <previous report>, stages whose median time grew by more than --threshold are reported
+and exit code is 1.
+
+python3 ./client/benchmarks/suite.py --avs 5000 --output report.json
+python3 ./client/benchmarks/suite.py --avs 5000 --compare report.json
+"""
+
+STAGES = ['rapidscan_read', 'parse_checksum_value', 'parse_app_version_value', 'lookup', 'process', 'find_path',
+          'find_structure', 'webdetect', 'scan_tree']
+
+
+def percentile(ordered: List[float], p: float) -> float:
+    # nearest-rank
+    return ordered[min(len(ordered) - 1, max(0, int(round(p / 100.0 * len(ordered) + 0.5)) - 1))]
+
+
+# :run(setup result) is timed, :setup is not; returns report of stage
+def measure(run: Callable, setup: Callable, repeat: int, items: int) -> Dict:
+    seconds = []
+    for _ in range(repeat):
+        arg = setup()
+        gc.collect()
+        started = time.perf_counter()
+        run(arg)
+        seconds.append(time.perf_counter() - started)
+    arg = setup()
+    gc.collect()
+    tracemalloc.start()
+    run(arg)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    seconds.sort()
+    median = percentile(seconds, 50)
+    return {'runs': repeat,
+            'items': items,
+            'seconds': {'min': seconds[0], 'p50': median, 'p90': percentile(seconds, 90),
+                        'p99': percentile(seconds, 99), 'max': seconds[-1]},
+            'items_per_second': items / median if median > 0 else None,
+            'peak_bytes': peak}
+
+
+class Bench:
+
+    def __init__(self, args, workdir: str):
+        self.args = args
+        self.db, self.checksums = webdetect_db(avs=args.avs, checksums_per_av=args.checksums_per_av,
+                                               depends_on_depth=args.depends_on_depth,
+                                               implies_fan_out=args.implies_fan_out, seed=args.seed)
+        self.files = host_files(self.db, self.checksums, present=args.present, absent=args.absent, seed=args.seed)
+
+        self.db_path = os.path.join(workdir, 'webdetect')
+        if args.backend == 'leveldb':
+            write_leveldb(self.db.items(), self.db_path)
+        else:
+            write_snapshot(sorted(self.db.items()), self.db_path, '0' * 64)
+        self.rapidscan_path = os.path.join(workdir, 'rapidscan')
+        write_rapidscan(self.files, self.rapidscan_path, as_file=args.rapidscan == 'file')
+        self.local = [(k, v[9:][:32]) for (k, v) in read_rapidscan(self.rapidscan_path)]
+        self.tree_path = os.path.join(workdir, 'tree')
+        if args.tree:
+            write_tree(self.files, self.tree_path)
+
+    def config(self) -> Dict:
+        return dict(vars(self.args), checksums=len(self.checksums), app_versions=len(self.db) - len(self.checksums),
+                    host_files=len(self.files))
+
+    def new_client(self, webdetect_db) -> WebdetectClient:
+        return WebdetectClient(get_by_key=webdetect_db.get_by_key,
+                               parse_checksum_value=webdetect_db.parse_checksum_value,
+                               parse_app_version_value=webdetect_db.parse_app_version_value,
+                               local_checksums=self.local,
+                               checksums_bound=0.5,
+                               get_by_keys=webdetect_db.get_by_keys if self.args.batched else None)
+
+    # same steps as rapidscan_db_to_structure after detection
+    def cs_with_paths(self, result: List[AppVersionEntry]) -> List[Tuple[AppVersionEntry, list]]:
+        cs_to_av = {cs: av for av in result for cs in av.used_cs}
+        path_index = build_path_index(read_rapidscan(self.rapidscan_path), set(cs_to_av.keys()))
+        av_to_cs_with_paths: Dict = {}
+        for (cs, paths) in path_index.cs_with_paths(cs_to_av.keys()):
+            av_to_cs_with_paths.setdefault(cs_to_av[cs], []).append((cs, paths))
+        return list(av_to_cs_with_paths.items())
+
+    def stages(self, webdetect_db) -> Dict[str, Tuple[Callable, Callable, int]]:
+        checksum_values = [self.db[cs] for cs in self.checksums]
+        app_version_values = [v for k, v in self.db.items() if len(k) == 4]
+
+        detecting = self.new_client(webdetect_db)
+        result = detecting.process()
+        av_cs_with_paths = self.cs_with_paths(result)
+        av_paths: List[AVE_Path] = [(av, path) for av, cs_with_paths in av_cs_with_paths
+                                    for path in detecting.find_path(cs_with_paths)]
+
+        def find_paths(_):
+            for _, cs_with_paths in av_cs_with_paths:
+                detecting.find_path(cs_with_paths)
+
+        def scan_tree(_):
+            from path_scanner import scan_for_cs
+            from rapidscan_writer import RapidscanFileWriter
+            writer = RapidscanFileWriter(os.devnull)
+            try:
+                scan_for_cs(self.tree_path, writer=writer)
+            finally:
+                writer.close()
+
+        def nothing():
+            return None
+
+        return {
+            'rapidscan_read': (lambda _: sum(1 for _ in read_rapidscan(self.rapidscan_path)), nothing, len(self.files)),
+            'parse_checksum_value': (lambda _: [WebdetectLevelDb.parse_checksum_value(v) for v in checksum_values],
+                                     nothing, len(checksum_values)),
+            'parse_app_version_value': (lambda _: [WebdetectLevelDb.parse_app_version_value(v)
+                                                   for v in app_version_values], nothing, len(app_version_values)),
+            'lookup': (lambda _: self.new_client(webdetect_db), nothing, len(self.local)),
+            'process': (lambda client: client.process(), lambda: self.new_client(webdetect_db),
+                        len(detecting.found_avs)),
+            'find_path': (find_paths, nothing, sum(len(x) for _, x in av_cs_with_paths)),
+            'find_structure': (lambda _: WebdetectClient.find_structure(av_paths), nothing, len(av_paths)),
+            'webdetect': (lambda _: webdetect(self.db_path, self.rapidscan_path), nothing, len(self.files)),
+            'scan_tree': (scan_tree, nothing, len(self.files)),
+        }
+
+    def run(self) -> Dict:
+        report = {'config': self.config(),
+                  'python': platform.python_version(),
+                  'stages': {}}
+        requested = self.args.stages.split(',') if self.args.stages else STAGES
+        webdetect_db = open_webdetect_db(self.db_path)
+        is_open = True
+        try:
+            stages = self.stages(webdetect_db)
+            for name in STAGES:
+                if name not in requested or (name == 'scan_tree' and not self.args.tree):
+                    continue
+                if name == 'webdetect':
+                    # webdetect() opens DB itself, LevelDB can be opened once per process; next stages do not use it
+                    webdetect_db.db.close()
+                    is_open = False
+                run, setup, items = stages[name]
+                report['stages'][name] = measure(run, setup, self.args.repeat, items)
+        finally:
+            if is_open:
+                webdetect_db.db.close()
+        return report
+
+
+def print_report(report: Dict, baseline: Optional[Dict], file):
+    print('%-24s %8s %10s %10s %10s %14s %10s%s' % ('stage', 'items', 'p50 ms', 'p90 ms', 'max ms', 'items/s',
+                                                   'peak MiB', '  vs baseline' if baseline else ''), file=file)
+    for name, stage in report['stages'].items():
+        seconds = stage['seconds']
+        line = '%-24s %8d %10.2f %10.2f %10.2f %14.0f %10.2f' % (
+            name, stage['items'], seconds['p50'] * 1e3, seconds['p90'] * 1e3, seconds['max'] * 1e3,
+            stage['items_per_second'] or 0, stage['peak_bytes'] / 2 ** 20)
+        if baseline and name in baseline['stages']:
+            line += '  %+.1f%%' % (100.0 * (seconds['p50'] / baseline['stages'][name]['seconds']['p50'] - 1))
+        print(line, file=file)
+
+
+# stages which median time grew by more than :threshold against :baseline
+def regressions(report: Dict, baseline: Dict, threshold: float) -> List[str]:
+    result = []
+    for name, stage in report['stages'].items():
+        previous = baseline['stages'].get(name)
+        if previous is not None and stage['seconds']['p50'] > previous['seconds']['p50'] * (1 + threshold):
+            result.append(name)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--avs', type=int, default=2000)
+    parser.add_argument('--checksums-per-av', type=int, default=200)
+    parser.add_argument('--depends-on-depth', type=int, default=2)
+    parser.add_argument('--implies-fan-out', type=int, default=3)
+    # share of checksums of installed app-versions present on host, count of files unknown to webdetect DB
+    parser.add_argument('--present', type=float, default=0.7)
+    parser.add_argument('--absent', type=int, default=50000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--backend', choices=['leveldb', 'snapshot'], default='leveldb')
+    parser.add_argument('--rapidscan', choices=['leveldb', 'file'], default='leveldb')
+    parser.add_argument('--batched', action='store_true')
+    parser.add_argument('--tree', action='store_true')
+    parser.add_argument('--stages', help='comma-separated subset of: ' + ','.join(STAGES))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--workdir', help='generated data is kept there instead of temporary directory')
+    parser.add_argument('--output')
+    parser.add_argument('--compare')
+    parser.add_argument('--threshold', type=float, default=0.2)
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='webdetect-bench-')
+    try:
+        report = Bench(args, workdir).run()
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(report, baseline, sys.stderr)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    if baseline is not None:
+        slower = regressions(report, baseline, args.threshold)
+        if slower:
+            print('regressions (> %.0f%% slower): %s' % (args.threshold * 100, ', '.join(slower)), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
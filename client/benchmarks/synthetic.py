@@ -0,0 +1,143 @@
+import hashlib
+import os
+import random
+import struct
+from typing import Dict, Iterable, List, Tuple
+
+from utils.rapidscan_writer import RapidscanFileWriter, RapidscanLevelDbWriter
+from webdetect import BARRIER_BYTE, WebdetectLevelDb
+
+"""
+Synthetic webdetect DB contents in the binary formats documented in WebdetectLevelDb, and hosts with
+app-versions of such DB installed: their files (as rapidscan DB/file or as directory tree).
+"""
+
+
+def av_id(index: int) -> bytes:
+    return struct.pack('>I', index)
+
+
+def checksum(seed: int, index: int) -> bytes:
+    return hashlib.sha256(b'%d:%d' % (seed, index)).digest()
+
+
+def app_version_value(app_versions: List[Tuple[str, str]], total: int, implies: List[bytes]) -> bytes:
+    strings = b''.join(app.encode('utf8') + b'\0' + version.encode('utf8') + b'\0' for app, version in app_versions)
+    return strings + b'\0' + bytes([total]) + b''.join(implies)
+
+
+def checksum_value(av: bytes, depends_on: List[bytes], depths: bytes) -> bytes:
+    return av + b''.join(depends_on) + BARRIER_BYTE + depths
+
+
+# returns webdetect DB as dict and list of all checksums in it
+# - :avs app-versions (one core per 50 of them, rest are plugins), each with up to :checksums_per_av checksums
+#   (255 at most, as 'total' is 1-byte)
+# - :depends_on_depth - each plugin version depends-on up to that many previous versions of the same plugin
+#   via first checksums of it
+# - :implies_fan_out - each core implies that many plugins
+def webdetect_db(avs: int, checksums_per_av: int, depends_on_depth: int = 1, implies_fan_out: int = 0,
+                 seed: int = 0) -> Tuple[Dict[bytes, bytes], List[bytes]]:
+    rnd = random.Random(seed)
+    db: Dict[bytes, bytes] = {}
+    checksums: List[bytes] = []
+    versions_per_plugin = max(depends_on_depth + 1, 1)
+    for i in range(1, avs + 1):
+        total = rnd.randint(1, min(checksums_per_av, 255))
+        if i % 50 == 1:
+            app, version, kind = 'wordpress-cores', '4.%d' % i, 'core'
+        else:
+            app, version, kind = 'wp.pplugin-%d' % (i // versions_per_plugin), '%d' % (i % versions_per_plugin), None
+        implies = [av_id(rnd.randint(1, avs)) for _ in range(implies_fan_out)] if kind == 'core' else []
+        db[av_id(i)] = app_version_value([(app, version)], total, implies)
+        previous = [av_id(i - d) for d in range(1, depends_on_depth + 1)
+                    if kind is None and i - d >= 1 and (i - d) % versions_per_plugin < i % versions_per_plugin]
+        for j in range(total):
+            cs = checksum(seed, len(checksums))
+            depends_on = previous if j < total // 4 else []
+            db[cs] = checksum_value(av_id(i), depends_on, bytes([rnd.randint(1, 3)]))
+            checksums.append(cs)
+    return db, checksums
+
+
+# rapidscan-like local checksums: :present of DB checksums plus :absent unknown ones, keys are 'rs<idx>'
+def local_checksums(checksums: List[bytes], present: float, absent: int, seed: int = 0) -> List[Tuple[bytes, bytes]]:
+    rnd = random.Random(seed)
+    result = [cs for cs in checksums if rnd.random() < present]
+    result += [checksum(seed + 1, i) for i in range(absent)]
+    rnd.shuffle(result)
+    return [(b'rs%d' % i, cs) for i, cs in enumerate(result)]
+
+
+def checksum_content(seed: int, index: int) -> bytes:
+    # sha256 of it is checksum(seed, index)
+    return b'%d:%d' % (seed, index)
+
+
+# files of a host with app-versions of webdetect_db(..., seed=:seed) installed, as (path, content):
+# - one site per core app-version (/var/www/site<k>), latest version of each plugin is installed into one of sites
+#   (wp-content/plugins/<plugin>)
+# - :present share of checksums of each installed app-version is present, at paths matching their depth levels
+# - :absent unknown files are put to wp-content/uploads of sites
+def host_files(db: Dict[bytes, bytes], checksums: List[bytes], present: float, absent: int,
+               seed: int = 0) -> List[Tuple[str, bytes]]:
+    rnd = random.Random(seed)
+    avs_checksums: Dict[bytes, List[int]] = {}
+    for index, cs in enumerate(checksums):
+        avs_checksums.setdefault(db[cs][:4], []).append(index)
+
+    cores: List[bytes] = []
+    latest_plugins: Dict[str, bytes] = {}
+    for av in sorted(avs_checksums.keys()):
+        app = WebdetectLevelDb.parse_app_version_value(db[av]).av[0].app
+        if app.endswith('-cores'):
+            cores.append(av)
+        else:
+            latest_plugins[app] = av
+    sites = ['/var/www/site%d' % i for i in range(len(cores))] or ['/var/www/site0']
+    roots = {av: sites[i] for i, av in enumerate(cores)}
+    for i, (app, av) in enumerate(sorted(latest_plugins.items())):
+        roots[av] = '%s/wp-content/plugins/%s' % (sites[i % len(sites)], app[len('wp.p'):])
+
+    files: List[Tuple[str, bytes]] = []
+    for av, root in roots.items():
+        for index in avs_checksums[av]:
+            if rnd.random() >= present:
+                continue
+            depth = WebdetectLevelDb.parse_checksum_value(db[checksums[index]])[2][0]
+            dirs = ''.join('/dir%d' % level for level in range(1, depth))
+            files.append(('%s%s/file%d' % (root, dirs, index), checksum_content(seed, index)))
+    for i in range(absent):
+        files.append(('%s/wp-content/uploads/upload%d' % (sites[i % len(sites)], i), checksum_content(seed + 1, i)))
+    rnd.shuffle(files)
+    return files
+
+
+def write_leveldb(items: Iterable[Tuple[bytes, bytes]], path: str):
+    import plyvel
+    db = plyvel.DB(path, create_if_missing=True)
+    try:
+        with db.write_batch() as batch:
+            for k, v in items:
+                batch.put(k, v)
+    finally:
+        db.close()
+
+
+# rapidscan LevelDB (:as_file False) or rapidscan file, as written by path_scanner.py
+def write_rapidscan(files: List[Tuple[str, bytes]], path: str, as_file: bool):
+    writer = RapidscanFileWriter(path) if as_file else RapidscanLevelDbWriter(path)
+    try:
+        for file_path, content in files:
+            writer.write(hashlib.sha256(content).hexdigest(), file_path.encode('utf8'))
+    finally:
+        writer.close()
+
+
+# materializes :files under :root
+def write_tree(files: List[Tuple[str, bytes]], root: str):
+    for file_path, content in files:
+        path = os.path.join(root, file_path.lstrip('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
@@ -0,0 +1,208 @@
+import argparse
+import json
+import os
+import socket
+import socketserver
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from av_cache import MemoryAppVersionCache
+from utils.rapidscan_writer import RAPIDSCAN_HEADER
+from webdetect import AVE_Path, WebdetectClient, detected_to_structure, layered_avs_to_layered_tags, \
+    open_webdetect_db, read_rapidscan, webdetect_db_identity
+
+"""
+Resident detection service: webdetect DB (LevelDB or snapshot) is opened once and decoded app-versions are cached
+across requests, so per-account detection does not pay interpreter start, DB open and app-version parsing.
+
+Requests are served over a Unix socket, one connection per request. Request is a JSON line:
+- {"rapidscan": "<path to rapidscan LevelDB or file>"}
+- {"checksums": "stream"}, followed by (<sha256 hex>\t<path>\n)* lines (same as webdetect_client.py input)
+  and an empty line
+- optional "output": "structure" (default) or "tags" (same as rapidscan_db_to_tags_with_paths)
+- {"command": "ping"} or {"command": "reload"} (reopens webdetect DB, i.e. after it was updated)
+Response is a JSON line: {"ok": true, "result": [...]} or {"ok": false, "error": "<message>"}, where result is
+list of {"av"/"tag": ..., "path": ..., "children": [{"av"/"tag": ..., "path": ...}]}.
+
+At most --jobs detections run concurrently, other requests wait. Lookups and parsing hold the GIL, so concurrency
+mostly overlaps reads of rapidscan and webdetect DBs; for CPU parallelism several daemons can share one snapshot.
+
+python3 daemon.py <path to webdetect leveldb or snapshot> <path to socket> [-j jobs] [--cache-bytes bytes]
+"""
+
+DEFAULT_CACHE_BYTES = 64 * (2 ** 20)
+
+
+class SynchronizedAppVersionCache:
+    # MemoryAppVersionCache shared by request threads
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.lock = threading.Lock()
+
+    def bind(self, db_identity: str):
+        with self.lock:
+            self.cache.bind(db_identity)
+
+    def get(self, av: bytes):
+        with self.lock:
+            return self.cache.get(av)
+
+    def put(self, av: bytes, entry, size: int):
+        with self.lock:
+            self.cache.put(av, entry, size)
+
+
+class WebdetectService:
+
+    def __init__(self, path_to_db: str, jobs: int, cache_bytes: int = DEFAULT_CACHE_BYTES):
+        self.path_to_db = path_to_db
+        self.av_cache = SynchronizedAppVersionCache(MemoryAppVersionCache(cache_bytes))
+        self.slots = threading.BoundedSemaphore(jobs)
+        # requests in progress use DB shared, reload waits for them and blocks new ones
+        self.db_lock = threading.Condition()
+        self.active = 0
+        self.reloading = False
+        self.db = None
+        self.open()
+
+    # private
+    def open(self):
+        self.db = open_webdetect_db(self.path_to_db)
+        self.av_cache.bind(webdetect_db_identity(self.path_to_db))
+
+    def reload(self):
+        with self.db_lock:
+            self.db_lock.wait_for(lambda: not self.reloading)
+            self.reloading = True
+            self.db_lock.wait_for(lambda: self.active == 0)
+            try:
+                self.db.db.close()
+                self.open()
+            finally:
+                self.reloading = False
+                self.db_lock.notify_all()
+
+    def close(self):
+        with self.db_lock:
+            self.db.db.close()
+
+    # :rapidscan_entries() returns new iterator over rapidscan (key, value) entries, it's called twice
+    def detect(self, rapidscan_entries, output: str) -> List[Dict]:
+        with self.slots:
+            with self.db_lock:
+                self.db_lock.wait_for(lambda: not self.reloading)
+                self.active += 1
+                db = self.db
+            try:
+                client = WebdetectClient(get_by_key=db.get_by_key,
+                                         parse_checksum_value=db.parse_checksum_value,
+                                         parse_app_version_value=db.parse_app_version_value,
+                                         local_checksums=((k, v[9:][:32]) for (k, v) in rapidscan_entries()),
+                                         checksums_bound=0.5,
+                                         get_by_keys=db.get_by_keys,
+                                         av_cache=self.av_cache)
+                structure = detected_to_structure(client.process(), client, rapidscan_entries())
+            finally:
+                with self.db_lock:
+                    self.active -= 1
+                    self.db_lock.notify_all()
+        if output == 'tags':
+            return tags_to_json(layered_avs_to_layered_tags(structure))
+        return structure_to_json(structure)
+
+
+def structure_to_json(structure: Dict[AVE_Path, List[AVE_Path]]) -> List[Dict]:
+    return [{'av': str(av), 'path': path, 'children': [{'av': str(child), 'path': child_path}
+                                                       for (child, child_path) in children]}
+            for (av, path), children in structure.items()]
+
+
+def tags_to_json(tags: Dict[Tuple[str, str], Iterable[Tuple[str, str]]]) -> List[Dict]:
+    return [{'tag': tag, 'path': path, 'children': [{'tag': child, 'path': child_path}
+                                                    for (child, child_path) in sorted(children)]}
+            for (tag, path), children in tags.items()]
+
+
+# (<sha256 hex>\t<path>\n)* lines up to an empty line, as rapidscan (key, value) entries
+def read_checksums_stream(stream) -> List[Tuple[bytes, bytes]]:
+    entries = []
+    for line in stream:
+        line = line.rstrip(b'\n')
+        if not line:
+            break
+        values = [x for x in line.split(b'\t') if len(x) > 0]
+        if len(values) == 2:
+            entries.append((values[1], RAPIDSCAN_HEADER + bytes.fromhex(values[0].decode('ascii'))))
+    return entries
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        service: WebdetectService = self.server.service
+        try:
+            request = json.loads(self.rfile.readline())
+            command = request.get('command', 'detect')
+            if command == 'ping':
+                result = 'pong'
+            elif command == 'reload':
+                service.reload()
+                result = 'reloaded'
+            elif 'rapidscan' in request:
+                path_to_rapidscan = request['rapidscan']
+                result = service.detect(lambda: read_rapidscan(path_to_rapidscan), request.get('output', 'structure'))
+            elif request.get('checksums') == 'stream':
+                entries = read_checksums_stream(self.rfile)
+                result = service.detect(lambda: entries, request.get('output', 'structure'))
+            else:
+                raise Exception("unknown request: %s" % request)
+            response = {'ok': True, 'result': result}
+        except Exception as e:
+            response = {'ok': False, 'error': str(e)}
+        self.wfile.write(json.dumps(response).encode('utf8') + b'\n')
+
+
+class WebdetectServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path_to_socket: str, service: WebdetectService):
+        self.service = service
+        super().__init__(path_to_socket, RequestHandler)
+
+
+# sends :request to daemon at :path_to_socket; :checksums - (sha256 hex, path) pairs of {"checksums": "stream"}
+def send_request(path_to_socket: str, request: Dict, checksums: Optional[Iterable[Tuple[str, str]]] = None) -> Dict:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path_to_socket)
+        with sock.makefile('rwb') as f:
+            f.write(json.dumps(request).encode('utf8') + b'\n')
+            if checksums is not None:
+                for (cs, path) in checksums:
+                    f.write(('%s\t%s\n' % (cs, path)).encode('utf8', 'surrogateescape'))
+                f.write(b'\n')
+            f.flush()
+            return json.loads(f.readline())
+
+
+def serve(path_to_db: str, path_to_socket: str, jobs: int, cache_bytes: int):
+    if os.path.exists(path_to_socket):
+        os.unlink(path_to_socket)
+    service = WebdetectService(path_to_db, jobs, cache_bytes)
+    try:
+        with WebdetectServer(path_to_socket, service) as server:
+            server.serve_forever()
+    finally:
+        service.close()
+        if os.path.exists(path_to_socket):
+            os.unlink(path_to_socket)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('webdetect_db')
+    parser.add_argument('socket')
+    parser.add_argument('-j', '--jobs', type=int, default=4)
+    parser.add_argument('--cache-bytes', type=int, default=DEFAULT_CACHE_BYTES)
+    args = parser.parse_args()
+    serve(args.webdetect_db, args.socket, args.jobs, args.cache_bytes)
@@ -0,0 +1,229 @@
+import os
+import pickle
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from webdetect import AppVersionEntry, WebdetectClient, open_webdetect_db, read_rapidscan, resolve_depends_on, \
+    webdetect, webdetect_db_identity
+
+"""
+Incremental re-detection: state of a previous detection run (WebdetectClient lookup state and matching result)
+is persisted, and later updated by rapidscan deltas - added and removed (rapidscan key, checksum) pairs.
+
+Only app-versions whose found checksums changed are re-evaluated, together with app-versions which depend-on them
+(transitively, via depends-on of found checksums) and app-versions implied by app-versions which appeared or
+disappeared; cost of update is proportional to the delta and that neighbourhood, not to the host size.
+
+State is bound to identity of webdetect DB it was built from: cached checksums and app-versions of previous DB
+contents can't be combined with lookups in updated DB, so delta over another DB is refused and a full run
+(webdetect_incremental_init) is required.
+"""
+
+
+class IncrementalWebdetect:
+    # :client - WebdetectClient after process()
+    # :cs_keys - all rapidscan keys of each found checksum (same file content may be present at several paths)
+    # :db_identity - identity of webdetect DB :client looked up in (see webdetect_db_identity)
+    def __init__(self, client: WebdetectClient, cs_keys: Dict[bytes, Set[bytes]], db_identity: Optional[str] = None):
+        self.client = client
+        self.cs_keys = cs_keys
+        self.db_identity = db_identity
+        # dependents[av][owner] - count of found checksums of :owner which depend-on :av
+        self.dependents: Dict[bytes, Dict[bytes, int]] = {}
+        # implied_by[av] - count of found app-versions which imply :av
+        self.implied_by: Dict[bytes, int] = {}
+        for cs, (av, cs_do, _) in client.checksums_cache.items():
+            self.link_checksum(av, cs_do, 1)
+        for av in client.found_avs.keys():
+            self.link_implies(av, 1)
+
+    # private
+    def link_checksum(self, av: bytes, cs_do: List[bytes], delta: int):
+        for dep in cs_do:
+            owners = self.dependents.setdefault(dep, {})
+            owners[av] = owners.get(av, 0) + delta
+            if owners[av] == 0:
+                del owners[av]
+
+    # private
+    def link_implies(self, av: bytes, delta: int):
+        for impl in self.client.app_versions_cache[av].impl:
+            self.implied_by[impl] = self.implied_by.get(impl, 0) + delta
+            if self.implied_by[impl] == 0:
+                del self.implied_by[impl]
+
+    # state is replaced atomically, so an interrupted save keeps the previous one
+    def save(self, path: str):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, mode='wb') as f:
+            pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path: str) -> 'IncrementalWebdetect':
+        with open(path, mode='rb') as f:
+            return pickle.load(f)
+
+    # returns (detected, lost, updated) app-versions:
+    # - detected - matched now, but not in previous state
+    # - lost - matched in previous state, but not now
+    # - updated - matched in both, but checksums used to detect them changed
+    def apply(self,
+              get_by_key: Callable[[bytes], Optional[bytes]],
+              parse_checksum_value: Callable[[bytes], Tuple[bytes, List[bytes], bytes]],
+              parse_app_version_value: Callable[[bytes], AppVersionEntry],
+              added: Iterable[Tuple[bytes, bytes]],
+              removed: Iterable[Tuple[bytes, bytes]]) \
+            -> Tuple[List[AppVersionEntry], List[AppVersionEntry], List[AppVersionEntry]]:
+        client = self.client
+        changed_avs: Set[bytes] = set()
+        # app-versions which appeared in or disappeared from found ones, their implies change
+        toggled_avs: Set[bytes] = set()
+
+        for (cs_key, cs) in removed:
+            keys = self.cs_keys.get(cs)
+            if keys is None:
+                continue
+            keys.discard(cs_key)
+            if keys:
+                if client.checksum_to_ldb_key[cs] == cs_key:
+                    client.checksum_to_ldb_key[cs] = next(iter(keys))
+                continue
+            del self.cs_keys[cs]
+            del client.checksum_to_ldb_key[cs]
+            av, cs_do, _ = client.checksums_cache.pop(cs)
+            self.link_checksum(av, cs_do, -1)
+            found = client.found_avs[av]
+            found.discard(cs)
+            changed_avs.add(av)
+            if not found:
+                del client.found_avs[av]
+                self.link_implies(av, -1)
+                toggled_avs.add(av)
+
+        for (cs_key, cs) in added:
+            keys = self.cs_keys.get(cs)
+            if keys is not None:
+                keys.add(cs_key)
+                client.checksum_to_ldb_key[cs] = cs_key
+                continue
+            cs_entry = get_by_key(cs)
+            if cs_entry is None:
+                continue
+            av, cs_do, depths = parse_checksum_value(cs_entry)
+            if av not in client.app_versions_cache:
+                av_entry = get_by_key(av)
+                if av_entry is None:
+                    raise Exception("db is invalid: app-version cannot be found")
+                client.app_versions_cache[av] = parse_app_version_value(av_entry)
+            self.cs_keys[cs] = {cs_key}
+            client.checksum_to_ldb_key[cs] = cs_key
+            client.checksums_cache[cs] = (av, cs_do, depths)
+            self.link_checksum(av, cs_do, 1)
+            if av not in client.found_avs:
+                client.found_avs[av] = set()
+                self.link_implies(av, 1)
+                toggled_avs.add(av)
+            client.found_avs[av].add(cs)
+            changed_avs.add(av)
+
+        previous_matching = set(client.matching_result)
+        affected = self.revalidate(changed_avs)
+        recheck = set(affected)
+        for av in toggled_avs:
+            recheck.update(client.app_versions_cache[av].impl)
+        for av in recheck:
+            if self.is_matching(av):
+                client.matching_result.add(av)
+                client.app_versions_cache[av].used_cs = client.found_avs[av]
+            else:
+                client.matching_result.discard(av)
+
+        detected = [client.app_versions_cache[av] for av in client.matching_result - previous_matching]
+        lost = [client.app_versions_cache[av] for av in previous_matching - client.matching_result]
+        updated = [client.app_versions_cache[av] for av in changed_avs & previous_matching & client.matching_result]
+        return detected, lost, updated
+
+    # private
+    # re-evaluates 'enough checksums' and depends-on validity for :changed_avs and all app-versions depending on them;
+    # validity of app-versions outside of that region does not change and is taken from previous state
+    def revalidate(self, changed_avs: Set[bytes]) -> Set[bytes]:
+        client = self.client
+        region = set(changed_avs)
+        worklist = list(changed_avs)
+        while worklist:
+            av = worklist.pop()
+            for owner in self.dependents.get(av, {}).keys():
+                if owner not in region:
+                    region.add(owner)
+                    worklist.append(owner)
+
+        for av in region:
+            if client.has_enough_checksums(av):
+                client.avs_having_enough_checksums.add(av)
+            else:
+                client.avs_having_enough_checksums.discard(av)
+        candidates = region & client.avs_having_enough_checksums
+
+        undecided = client.undecided_avs - region
+
+        def clauses():
+            for owner in candidates:
+                for cs in client.found_avs[owner]:
+                    cs_do = client.checksums_cache[cs][1]
+                    # depends-on outside of region is already decided: valid one makes checksum useless,
+                    # invalid one is ignored, undecided one (depends-on cycle) keeps checksum unproven
+                    if any(dep not in region and client.is_valid_by_depends_on(dep) for dep in cs_do):
+                        continue
+                    yield owner, [dep for dep in cs_do if dep in region or dep in undecided]
+
+        valid, cycles, client.validity_stats = resolve_depends_on(candidates, clauses(), undecided)
+        client.undecided_avs = undecided | cycles
+        for av in region:
+            if av in candidates:
+                client.memoized_is_valid_cache[av] = av in valid
+            else:
+                client.memoized_is_valid_cache.pop(av, None)
+        return region
+
+    # private; same as WebdetectClient.process: valid by depends-on, or implied by some found app-version
+    def is_matching(self, av: bytes) -> bool:
+        client = self.client
+        if client.is_valid_by_depends_on(av):
+            return True
+        return av in self.implied_by and av in client.found_avs and client.has_enough_checksums(av)
+
+
+# full detection run, which also stores state for further webdetect_delta runs at :path_to_state
+def webdetect_incremental_init(path_to_webdetect_leveldb: str,
+                               path_to_rapidscan_leveldb: str,
+                               path_to_state: str) -> List[AppVersionEntry]:
+    # taken before lookups, so DB changed during them is not considered the same by webdetect_delta
+    db_identity = webdetect_db_identity(path_to_webdetect_leveldb)
+    result, client = webdetect(path_to_webdetect_leveldb, path_to_rapidscan_leveldb)
+    cs_keys: Dict[bytes, Set[bytes]] = {}
+    for (k, v) in read_rapidscan(path_to_rapidscan_leveldb):
+        cs = v[9:][:32]
+        if cs in client.checksums_cache:
+            cs_keys.setdefault(cs, set()).add(k)
+    IncrementalWebdetect(client, cs_keys, db_identity).save(path_to_state)
+    return result
+
+
+def webdetect_delta(path_to_webdetect_leveldb: str,
+                    path_to_state: str,
+                    added: Iterable[Tuple[bytes, bytes]],
+                    removed: Iterable[Tuple[bytes, bytes]]):
+    state = IncrementalWebdetect.load(path_to_state)
+    if state.db_identity != webdetect_db_identity(path_to_webdetect_leveldb):
+        raise Exception("webdetect DB was changed since state was created, webdetect_incremental_init is required")
+    webdetect_leveldb = open_webdetect_db(path_to_webdetect_leveldb)
+    try:
+        changes = state.apply(get_by_key=webdetect_leveldb.get_by_key,
+                              parse_checksum_value=webdetect_leveldb.parse_checksum_value,
+                              parse_app_version_value=webdetect_leveldb.parse_app_version_value,
+                              added=added,
+                              removed=removed)
+    finally:
+        webdetect_leveldb.db.close()
+    state.save(path_to_state)
+    return changes
@@ -0,0 +1,157 @@
+import contextlib
+import json
+import time
+from typing import Callable, Dict, Iterable, List, Optional
+
+"""
+Per-stage timings and counters of a detection run, to tell where time of a slow run goes: rapidscan iteration,
+webdetect DB lookups, parsing, depends-on resolution, path attribution.
+
+Instrumentation is passed to webdetect()/rapidscan_db_to_structure()/WebdetectClient; without it NULL_INSTRUMENTATION
+is used, which does not wrap anything, so disabled instrumentation costs a few no-op calls per run.
+
+Stages are either blocks (stage(), wall and CPU time, reported to :on_stage hook when finished) or wrapped
+callables/iterators (timed(), timed_lookup(), timed_iter(); wall time only, summed over calls). Stages can be nested,
+i.e. 'lookup' includes time of 'get_by_key', 'parse_checksum_value' and 'local_checksums' (rapidscan iteration).
+"""
+
+
+class Instrumentation:
+
+    # :on_stage(name, wall seconds, cpu seconds) is called when each stage() block is finished
+    def __init__(self, on_stage: Optional[Callable[[str, float, float], None]] = None):
+        self.on_stage = on_stage
+        # stage -> [calls, wall seconds, cpu seconds or None]
+        self.stages: Dict[str, List] = {}
+        self.counters: Dict[str, float] = {}
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.process_time() - cpu
+            self.record(name, wall, cpu)
+            if self.on_stage is not None:
+                self.on_stage(name, wall, cpu)
+
+    # private
+    def record(self, name: str, wall: float, cpu: Optional[float], calls: int = 1):
+        stage = self.stages.get(name)
+        if stage is None:
+            self.stages[name] = [calls, wall, cpu]
+            return
+        stage[0] += calls
+        stage[1] += wall
+        if cpu is not None:
+            stage[2] = (stage[2] or 0.0) + cpu
+
+    def count(self, name: str, value: float = 1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    # adds all :counters (i.e. validity_stats of WebdetectClient) as <prefix>_<name>
+    def add_counters(self, prefix: str, counters: Dict[str, float]):
+        for name, value in counters.items():
+            self.count('%s_%s' % (prefix, name), value)
+
+    def timed(self, name: str, fn: Callable) -> Callable:
+        record = self.record
+        clock = time.perf_counter
+
+        def wrapper(*args):
+            started = clock()
+            try:
+                return fn(*args)
+            finally:
+                record(name, clock() - started, None)
+        return wrapper
+
+    # same as timed(), for get_by_key: also counts <name>_hits and <name>_misses
+    def timed_lookup(self, name: str, get_by_key: Callable[[bytes], Optional[bytes]]) \
+            -> Callable[[bytes], Optional[bytes]]:
+        timed_get = self.timed(name, get_by_key)
+        counters = self.counters
+        hits, misses = name + '_hits', name + '_misses'
+
+        def wrapper(key: bytes) -> Optional[bytes]:
+            value = timed_get(key)
+            counter = misses if value is None else hits
+            counters[counter] = counters.get(counter, 0) + 1
+            return value
+        return wrapper
+
+    # same as timed_lookup(), for get_by_keys: counts keys instead of calls
+    def timed_batch_lookup(self, name: str, get_by_keys: Callable[[Iterable[bytes]], Dict[bytes, bytes]]) \
+            -> Callable[[Iterable[bytes]], Dict[bytes, bytes]]:
+        timed_get = self.timed(name, get_by_keys)
+
+        def wrapper(keys: Iterable[bytes]) -> Dict[bytes, bytes]:
+            keys = list(keys)
+            values = timed_get(keys)
+            self.count(name + '_keys', len(keys))
+            self.count(name + '_hits', len(values))
+            self.count(name + '_misses', len(keys) - len(values))
+            return values
+        return wrapper
+
+    # time spent in producing items of :iterable (i.e. reading rapidscan DB), calls are items count
+    def timed_iter(self, name: str, iterable: Iterable) -> Iterable:
+        iterator = iter(iterable)
+        clock = time.perf_counter
+        wall = 0.0
+        items = 0
+        try:
+            while True:
+                started = clock()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    wall += clock() - started
+                items += 1
+                yield item
+        finally:
+            self.record(name, wall, None, items)
+
+    def to_dict(self) -> Dict:
+        return {'stages': {name: {'calls': calls, 'wall': wall, 'cpu': cpu}
+                           for name, (calls, wall, cpu) in self.stages.items()},
+                'counters': dict(self.counters)}
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), indent=2, sort_keys=True)
+
+
+class NullInstrumentation:
+    # same interface as Instrumentation, records nothing and returns callables as is
+
+    def stage(self, name: str):
+        return contextlib.nullcontext()
+
+    def count(self, name: str, value: float = 1):
+        pass
+
+    def add_counters(self, prefix: str, counters: Dict[str, float]):
+        pass
+
+    def timed(self, name: str, fn: Callable) -> Callable:
+        return fn
+
+    def timed_lookup(self, name: str, get_by_key: Callable) -> Callable:
+        return get_by_key
+
+    def timed_batch_lookup(self, name: str, get_by_keys: Callable) -> Callable:
+        return get_by_keys
+
+    def timed_iter(self, name: str, iterable: Iterable) -> Iterable:
+        return iterable
+
+    def to_dict(self) -> Dict:
+        return {'stages': {}, 'counters': {}}
+
+
+NULL_INSTRUMENTATION = NullInstrumentation()
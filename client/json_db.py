@@ -0,0 +1,168 @@
+import hashlib
+import json
+import os
+import re
+import struct
+import sys
+from typing import Dict, IO, Iterable, Optional, Tuple
+
+from snapshot import write_snapshot
+from webdetect import BARRIER_BYTE, WebdetectLevelDb
+
+"""
+JSON debug backend of webdetect DB, used to reproduce detections offline from DB dumps.
+
+Dump is a JSON object, or NDJSON - any number of JSON objects (i.e. one per line), with entries:
+- "<hex sha256>": [<app-version id>, ...<depends-on app-version ids>, -1, ...<depth levels>]
+- "<app-version id>": {"av": [{"app": <app>, "version": <version>}, ...], "total": <total>, "impl": [<ids>]}
+
+Dump is streamed: each entry is decoded on its own and stored in WebdetectLevelDb binary layout in a single buffer,
+indexed by raw key (app-version ids are 4-byte big-endian), so no Python objects are kept per entry except index
+items; AppVersionEntry objects are created on first access by WebdetectClient with WebdetectLevelDb.parse_* functions.
+
+Loading is bound by JSON decoding (~1 us per entry); a dump which is used repeatedly can be converted once
+to a snapshot (see snapshot.py), which is opened instantly and accepted everywhere webdetect LevelDB is.
+
+python3 json_db.py dump <path to webdetect leveldb> <path to NDJSON dump>
+python3 json_db.py snapshot <path to JSON/NDJSON dump> <path to snapshot>
+"""
+
+AV_ID = struct.Struct('>I')
+CHECKSUM_HEX_LENGTH = 64
+BARRIER_ID = -1
+READ_SIZE = 16 * (2 ** 20)
+# entry which cannot be decoded from that many characters is invalid, not cut by the end of buffer
+MAX_ENTRY_SIZE = READ_SIZE
+# separators before top-level entry (whitespace, object braces, commas) and its key; keys are hex checksums or
+# decimal ids, so they have no escapes
+ENTRY_KEY = re.compile(r'[\s{},]*"([^"\\]*)"\s*:\s*')
+ENTRY_SEPARATORS = re.compile(r'[\s{},]*')
+
+
+def is_json_db(path: str) -> bool:
+    if not os.path.isfile(path):
+        return False
+    with open(path, mode='rb') as f:
+        return f.read(4096).lstrip()[:1] == b'{'
+
+
+# yields (key, value) entries of JSON or NDJSON dump, reading :file by chunks
+def read_entries(file: IO[str], read_size: int = READ_SIZE) -> Iterable[Tuple[str, object]]:
+    raw_decode = json.JSONDecoder().raw_decode
+    buffer = ''
+    pos = 0
+    eof = False
+    while True:
+        key_match = ENTRY_KEY.match(buffer, pos)
+        if key_match is not None:
+            try:
+                value, end = raw_decode(buffer, key_match.end())
+                yield key_match.group(1), value
+                pos = end
+                continue
+            except ValueError:
+                pass
+        # entry is cut by the end of buffer, it is read again with next chunk
+        if eof or len(buffer) - pos > MAX_ENTRY_SIZE:
+            if ENTRY_SEPARATORS.match(buffer, pos).end() < len(buffer):
+                raise Exception("db is invalid: cannot decode %s" % buffer[pos:][:100])
+            return
+        chunk = file.read(read_size)
+        eof = len(chunk) == 0
+        buffer = buffer[pos:] + chunk
+        pos = 0
+
+
+def encode_checksum_value(value: list) -> bytes:
+    if BARRIER_ID in value:
+        barrier = value.index(BARRIER_ID)
+        ids, depths = value[:barrier], value[barrier + 1:]
+    else:
+        # dumps of old DB versions have no depth levels
+        ids, depths = value, []
+    return struct.pack('>%dI' % len(ids), *ids) + BARRIER_BYTE + bytes(depths)
+
+
+def encode_app_version_value(value: dict) -> bytes:
+    strings = b''.join(x['app'].encode('utf8') + b'\0' + x['version'].encode('utf8') + b'\0' for x in value['av'])
+    return strings + b'\0' + bytes([value['total']]) + struct.pack('>%dI' % len(value['impl']), *value['impl'])
+
+
+class WebdetectJsonDb(WebdetectLevelDb):
+
+    def __init__(self, path_to_db: str):
+        # raw key -> (offset << 32 | length) of value in :values
+        self.index: Dict[bytes, int] = {}
+        index = self.index
+        values = bytearray()
+        with open(path_to_db, mode='r', encoding='utf-8') as file_db:
+            for (key, value) in read_entries(file_db):
+                if len(key) == CHECKSUM_HEX_LENGTH and isinstance(value, list):
+                    raw_key = bytes.fromhex(key)
+                    raw_value = encode_checksum_value(value)
+                else:
+                    raw_key = AV_ID.pack(int(key))
+                    raw_value = encode_app_version_value(value)
+                index[raw_key] = (len(values) << 32) | len(raw_value)
+                values += raw_value
+        self.values = bytes(values)
+
+    def get_by_key(self, key: bytes) -> Optional[bytes]:
+        ref = self.index.get(key)
+        if ref is None:
+            return None
+        offset = ref >> 32
+        return self.values[offset:offset + (ref & 0xFFFFFFFF)]
+
+    def get_by_keys(self, keys: Iterable[bytes]) -> Dict[bytes, bytes]:
+        result: Dict[bytes, bytes] = {}
+        for key in set(keys):
+            value = self.get_by_key(key)
+            if value is not None:
+                result[key] = value
+        return result
+
+    def items(self) -> Iterable[Tuple[bytes, bytes]]:
+        for key in sorted(self.index.keys()):
+            yield key, self.get_by_key(key)
+
+
+# identity of dump for app-version caches bound to snapshot (see av_cache.leveldb_identity)
+def dump_identity(path_to_dump: str) -> str:
+    stat = os.stat(path_to_dump)
+    description = '%s:%d:%d' % (os.path.abspath(path_to_dump), stat.st_size, stat.st_mtime_ns)
+    return hashlib.sha256(description.encode('utf8')).hexdigest()
+
+
+def json_to_snapshot(path_to_dump: str, path_to_snapshot: str):
+    write_snapshot(WebdetectJsonDb(path_to_dump).items(), path_to_snapshot, dump_identity(path_to_dump))
+
+
+# writes webdetect LevelDB as NDJSON dump, one entry per line
+def dump_json(path_to_webdetect_leveldb: str, path_to_dump: str):
+    webdetect_leveldb = WebdetectLevelDb(path_to_webdetect_leveldb)
+    try:
+        with open(path_to_dump, mode='w', encoding='utf-8') as f:
+            for key, value in webdetect_leveldb.db.iterator():
+                if len(key) == AV_ID.size:
+                    entry = WebdetectLevelDb.parse_app_version_value(value)
+                    dumped = {'av': [{'app': x.app, 'version': x.version} for x in entry.av],
+                              'total': entry.total,
+                              'impl': [AV_ID.unpack(x)[0] for x in entry.impl]}
+                    f.write(json.dumps({str(AV_ID.unpack(key)[0]): dumped}))
+                else:
+                    av, cs_do, depths = WebdetectLevelDb.parse_checksum_value(value)
+                    dumped = [AV_ID.unpack(x)[0] for x in [av] + cs_do] + [BARRIER_ID] + list(depths)
+                    f.write(json.dumps({key.hex(): dumped}))
+                f.write('\n')
+    finally:
+        webdetect_leveldb.db.close()
+
+
+if __name__ == '__main__':
+    if sys.argv[1] == 'dump':
+        dump_json(sys.argv[2], sys.argv[3])
+    elif sys.argv[1] == 'snapshot':
+        json_to_snapshot(sys.argv[2], sys.argv[3])
+    else:
+        raise Exception("unknown command %s" % sys.argv[1])
@@ -0,0 +1,126 @@
+import os
+import sys
+from array import array
+from typing import Callable, Dict, Iterable, List, Set, Tuple
+
+"""
+Checksum -> paths index with shared-prefix compression: every directory is stored once as (parent directory id, name)
+and every file as (directory id, interned base name), so millions of paths of similar installations fit in memory.
+Paths are split by '/' and joined back losslessly, i.e. PathIndex.path(PathIndex.add(p)) == p.
+
+AncestorIndex is used by WebdetectClient.find_path to remove depth levels from paths by id lookups.
+"""
+
+PATH_SEPARATOR = '/'
+NO_PARENT = -1
+
+
+class PathIndex:
+
+    def __init__(self):
+        # directory i is :dir_names[i] inside of directory :dir_parents[i]
+        self.dir_parents = array('i')
+        self.dir_names: List[str] = []
+        self.dir_ids: Dict[Tuple[int, str], int] = {}
+        # file i is :file_names[i] inside of directory :file_dirs[i]
+        self.file_dirs = array('i')
+        self.file_names: List[str] = []
+        # checksum -> ids of files having it
+        self.cs_files: Dict[bytes, List[int]] = {}
+
+    # private
+    def directory(self, parent: int, name: str) -> int:
+        key = (parent, name)
+        dir_id = self.dir_ids.get(key)
+        if dir_id is None:
+            dir_id = len(self.dir_names)
+            self.dir_ids[key] = dir_id
+            self.dir_parents.append(parent)
+            self.dir_names.append(sys.intern(name))
+        return dir_id
+
+    # returns file id
+    def add(self, path: str) -> int:
+        components = path.split(PATH_SEPARATOR)
+        parent = NO_PARENT
+        for name in components[:-1]:
+            parent = self.directory(parent, name)
+        self.file_dirs.append(parent)
+        self.file_names.append(sys.intern(components[-1]))
+        return len(self.file_names) - 1
+
+    def add_checksum_path(self, cs: bytes, path: str):
+        self.cs_files.setdefault(cs, []).append(self.add(path))
+
+    def dir_path(self, dir_id: int) -> str:
+        components = []
+        while dir_id != NO_PARENT:
+            components.append(self.dir_names[dir_id])
+            dir_id = self.dir_parents[dir_id]
+        components.reverse()
+        return PATH_SEPARATOR.join(components)
+
+    def path(self, file_id: int) -> str:
+        dir_id = self.file_dirs[file_id]
+        if dir_id == NO_PARENT:
+            return self.file_names[file_id]
+        return self.dir_path(dir_id) + PATH_SEPARATOR + self.file_names[file_id]
+
+    def paths(self, cs: bytes) -> List[str]:
+        return [self.path(file_id) for file_id in self.cs_files.get(cs, ())]
+
+    def cs_with_paths(self, checksums: Iterable[bytes]) -> List[Tuple[bytes, List[str]]]:
+        return [(cs, self.paths(cs)) for cs in checksums if cs in self.cs_files]
+
+
+class AncestorIndex:
+    # Interns path strings to ids; parent of each path is evaluated once with os.path.split (so results are the same
+    # as for repeated os.path.split), and ancestors of each path are kept as an array: k-th ancestor is a lookup.
+
+    def __init__(self):
+        self.ids: Dict[str, int] = {}
+        self.names: List[str] = []
+        self.parents = array('i')
+        self.ancestors: List[List[int]] = []
+
+    def node(self, path: str) -> int:
+        node = self.ids.get(path)
+        if node is None:
+            node = len(self.names)
+            self.ids[path] = node
+            self.names.append(path)
+            self.parents.append(NO_PARENT)
+            self.ancestors.append([node])
+        return node
+
+    # private
+    def parent(self, node: int) -> int:
+        parent = self.parents[node]
+        if parent == NO_PARENT:
+            parent = self.node(os.path.split(self.names[node])[0])
+            self.parents[node] = parent
+        return parent
+
+    # same as os.path.split applied :depth times to path :node
+    def ancestor(self, node: int, depth: int) -> int:
+        ancestors = self.ancestors[node]
+        while len(ancestors) <= depth:
+            ancestors.append(self.parent(ancestors[-1]))
+        return ancestors[depth]
+
+
+def rapidscan_key_to_path(key: bytes) -> str:
+    # rapidscan keys are paths of scanned files
+    return key.decode("utf-8", errors="ignore")
+
+
+# one pass over rapidscan DB entries (key, value), indexing paths of :checksums only
+def build_path_index(rapidscan_entries: Iterable[Tuple[bytes, bytes]],
+                     checksums: Set[bytes],
+                     key_to_path: Callable[[bytes], str] = rapidscan_key_to_path) -> PathIndex:
+    index = PathIndex()
+    for (k, v) in rapidscan_entries:
+        cs = v[9:][:32]
+        if cs in checksums:
+            index.add_checksum_path(cs, key_to_path(k))
+    return index
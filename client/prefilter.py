@@ -0,0 +1,109 @@
+import mmap
+import struct
+import sys
+from typing import Callable, Dict, Iterable, Optional
+
+import plyvel
+
+from av_cache import leveldb_identity
+
+"""
+Bloom filter of all checksum keys of webdetect LevelDB. Most files on a host are not in webdetect DB,
+so lookups of checksums ruled out by the filter are skipped; the filter is mmap-ed, so opening it costs nothing
+and its pages are shared by all clients on the host.
+
+Checksums are SHA-256 digests, i.e. already uniformly distributed, so bit positions are derived directly from
+digest bytes with double hashing: position_i = (h1 + i * h2) mod m, h1 and h2 are first two 64-bit words of digest.
+
+File format: HEADER (magic, identity of source LevelDB (see av_cache.leveldb_identity), bits count m,
+hash functions count k, keys count n), then m bits. Filter of other contents of webdetect DB would rule out
+checksums added since it was built, so clients use filter only if its identity is the identity of their DB.
+
+python3 prefilter.py <path to webdetect leveldb> <path to filter> [bits per key]
+"""
+
+MAGIC = b'WDBF\x00\x00\x00\x02'
+HEADER = struct.Struct('<8s64sQIQ')
+DIGEST_WORDS = struct.Struct('<QQ')
+CHECKSUM_SIZE = 32
+DEFAULT_BITS_PER_KEY = 10
+# ln(2) * bits per key, rounded; gives ~1% false positives for 10 bits per key
+HASHES_PER_BITS_PER_KEY = 0.69
+
+
+def bit_positions(cs: bytes, bits: int, hashes: int) -> Iterable[int]:
+    h1, h2 = DIGEST_WORDS.unpack_from(cs)
+    h2 |= 1
+    return ((h1 + i * h2) % bits for i in range(hashes))
+
+
+# :identity - identity of webdetect DB :keys are read from
+def build_filter_from_keys(keys: Iterable[bytes], keys_count: int, path_to_filter: str, identity: str,
+                           bits_per_key: int = DEFAULT_BITS_PER_KEY):
+    bits = max(keys_count * bits_per_key, 64)
+    hashes = max(1, round(bits_per_key * HASHES_PER_BITS_PER_KEY))
+    table = bytearray((bits + 7) // 8)
+    added = 0
+    for key in keys:
+        if len(key) != CHECKSUM_SIZE:
+            continue
+        for position in bit_positions(key, bits, hashes):
+            table[position >> 3] |= 1 << (position & 7)
+        added += 1
+    with open(path_to_filter, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, identity.encode('ascii'), bits, hashes, added))
+        f.write(table)
+
+
+def build_filter(path_to_webdetect_leveldb: str, path_to_filter: str, bits_per_key: int = DEFAULT_BITS_PER_KEY):
+    identity = leveldb_identity(path_to_webdetect_leveldb)
+    db = plyvel.DB(path_to_webdetect_leveldb)
+    try:
+        keys_count = sum(1 for key in db.iterator(include_value=False) if len(key) == CHECKSUM_SIZE)
+        build_filter_from_keys(db.iterator(include_value=False), keys_count, path_to_filter, identity, bits_per_key)
+    finally:
+        db.close()
+
+
+class ChecksumFilter:
+
+    def __init__(self, path_to_filter: str):
+        with open(path_to_filter, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, identity, self.bits, self.hashes, self.keys_count = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise Exception("%s is not a checksum filter" % path_to_filter)
+        self.identity = identity.rstrip(b'\0').decode('ascii')
+        self.table = memoryview(self.mm)[HEADER.size:]
+
+    # False only if :key is a checksum which is surely absent in webdetect DB
+    def might_contain(self, key: bytes) -> bool:
+        if len(key) != CHECKSUM_SIZE:
+            return True
+        # bit_positions inlined, this is called for every local checksum
+        table = self.table
+        bits = self.bits
+        h1, h2 = DIGEST_WORDS.unpack_from(key)
+        h2 |= 1
+        for _ in range(self.hashes):
+            position = h1 % bits
+            if not table[position >> 3] & (1 << (position & 7)):
+                return False
+            h1 += h2
+        return True
+
+    def filtered_get_by_key(self, get_by_key: Callable[[bytes], Optional[bytes]]) \
+            -> Callable[[bytes], Optional[bytes]]:
+        return lambda key: get_by_key(key) if self.might_contain(key) else None
+
+    def filtered_get_by_keys(self, get_by_keys: Callable[[Iterable[bytes]], Dict[bytes, bytes]]) \
+            -> Callable[[Iterable[bytes]], Dict[bytes, bytes]]:
+        return lambda keys: get_by_keys([key for key in keys if self.might_contain(key)])
+
+    def close(self):
+        self.table.release()
+        self.mm.close()
+
+
+if __name__ == '__main__':
+    build_filter(sys.argv[1], sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else DEFAULT_BITS_PER_KEY)
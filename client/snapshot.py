@@ -0,0 +1,162 @@
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import time
+from typing import IO, Dict, Iterable, List, Optional, Tuple
+
+from av_cache import leveldb_identity
+
+"""
+Frozen, read-only snapshot of webdetect LevelDB in a single file, read via mmap: opening it costs a few page reads,
+and all client processes on the host share the same page-cached file (LevelDB needs an exclusive lock per process).
+
+Keys are grouped into tables by key width (32-byte checksums, 4-byte app-version ids); each table is an array of
+fixed-width records <key><8-byte value offset><4-byte value length> sorted by key, with a fan-out index by first
+two key bytes (cumulative record counts, as in git pack index), so lookup is a binary search over a few records.
+Values are stored as is, i.e. they are parsed with WebdetectLevelDb.parse_* functions.
+
+File format (integers are little-endian):
+- HEADER: magic (with format version), identity of source LevelDB (see av_cache.leveldb_identity), creation time,
+  offset of tables directory, tables count
+- values
+- for each table: records, then fan-out index (256 ** prefix bytes + 1 4-byte counts)
+- tables directory: TABLE entry per table
+
+python3 snapshot.py <path to webdetect leveldb> <path to snapshot>
+"""
+
+MAGIC = b'WDSS\x00\x00\x00\x01'
+HEADER = struct.Struct('<8s64sQQI')
+TABLE = struct.Struct('<IQQQ')
+VALUE_REF = struct.Struct('<QI')
+FANOUT_ENTRY = struct.Struct('<I')
+FANOUT_PREFIX_BYTES = 2
+WRITE_BUFFER_SIZE = 2 ** 20
+
+
+def prefix_bytes(width: int) -> int:
+    return min(width, FANOUT_PREFIX_BYTES)
+
+
+def is_snapshot(path: str) -> bool:
+    if not os.path.isfile(path):
+        return False
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+# :items - (key, value) pairs sorted by key (as LevelDB iterates them)
+def write_snapshot(items: Iterable[Tuple[bytes, bytes]], path_to_snapshot: str, identity: str):
+    # records of each table are spilled to temporary files while values are written, tables are appended after values
+    records: Dict[int, Tuple[IO[bytes], List[int]]] = {}
+    tmp_path = path_to_snapshot + '.tmp'
+    with open(tmp_path, 'wb', buffering=WRITE_BUFFER_SIZE) as f:
+        f.write(HEADER.pack(MAGIC, identity.encode('ascii'), 0, 0, 0))
+        offset = HEADER.size
+        for key, value in items:
+            width = len(key)
+            table = records.get(width)
+            if table is None:
+                table = (tempfile.TemporaryFile(buffering=WRITE_BUFFER_SIZE), [0] * (256 ** prefix_bytes(width)))
+                records[width] = table
+            table[0].write(key + VALUE_REF.pack(offset, len(value)))
+            table[1][int.from_bytes(key[:prefix_bytes(width)], 'big')] += 1
+            f.write(value)
+            offset += len(value)
+
+        directory = []
+        for width in sorted(records.keys()):
+            spill, counts = records[width]
+            spill.seek(0)
+            records_offset = offset
+            for chunk in iter(lambda: spill.read(WRITE_BUFFER_SIZE), b''):
+                f.write(chunk)
+                offset += len(chunk)
+            spill.close()
+            fanout_offset = offset
+            total = 0
+            f.write(FANOUT_ENTRY.pack(0))
+            for count in counts:
+                total += count
+                f.write(FANOUT_ENTRY.pack(total))
+            offset += FANOUT_ENTRY.size * (len(counts) + 1)
+            directory.append(TABLE.pack(width, total, records_offset, fanout_offset))
+        for entry in directory:
+            f.write(entry)
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, identity.encode('ascii'), int(time.time()), offset, len(directory)))
+        f.flush()
+        os.fsync(f.fileno())
+    # replaced atomically: clients which have mapped previous snapshot keep reading it
+    os.replace(tmp_path, path_to_snapshot)
+
+
+def convert(path_to_webdetect_leveldb: str, path_to_snapshot: str):
+    # reading snapshots does not require plyvel
+    import plyvel
+    identity = leveldb_identity(path_to_webdetect_leveldb)
+    db = plyvel.DB(path_to_webdetect_leveldb)
+    try:
+        snapshot = db.snapshot()
+        try:
+            with snapshot.iterator() as it:
+                write_snapshot(it, path_to_snapshot, identity)
+        finally:
+            snapshot.close()
+    finally:
+        db.close()
+
+
+class Snapshot:
+
+    def __init__(self, path_to_snapshot: str):
+        with open(path_to_snapshot, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, identity, self.created, directory_offset, tables_count = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise Exception("%s is not a webdetect snapshot" % path_to_snapshot)
+        self.identity = identity.decode('ascii')
+        # key width -> (records count, records offset, fan-out index offset, record size)
+        self.tables: Dict[int, Tuple[int, int, int, int]] = {}
+        for i in range(tables_count):
+            width, count, records_offset, fanout_offset = TABLE.unpack_from(self.mm, directory_offset + i * TABLE.size)
+            self.tables[width] = (count, records_offset, fanout_offset, width + VALUE_REF.size)
+
+    def get(self, key: bytes) -> Optional[bytes]:
+        width = len(key)
+        table = self.tables.get(width)
+        if table is None:
+            return None
+        _, records_offset, fanout_offset, record_size = table
+        mm = self.mm
+        prefix = int.from_bytes(key[:prefix_bytes(width)], 'big')
+        lo, hi = struct.unpack_from('<II', mm, fanout_offset + prefix * FANOUT_ENTRY.size)
+        while lo < hi:
+            mid = (lo + hi) >> 1
+            position = records_offset + mid * record_size
+            mid_key = mm[position:position + width]
+            if mid_key < key:
+                lo = mid + 1
+            elif mid_key > key:
+                hi = mid
+            else:
+                value_offset, value_length = VALUE_REF.unpack_from(mm, position + width)
+                return mm[value_offset:value_offset + value_length]
+        return None
+
+    # all (key, value) pairs, grouped by key width
+    def items(self) -> Iterable[Tuple[bytes, bytes]]:
+        mm = self.mm
+        for width, (count, records_offset, _, record_size) in sorted(self.tables.items()):
+            for position in range(records_offset, records_offset + count * record_size, record_size):
+                value_offset, value_length = VALUE_REF.unpack_from(mm, position + width)
+                yield mm[position:position + width], mm[value_offset:value_offset + value_length]
+
+    def close(self):
+        self.mm.close()
+
+
+if __name__ == '__main__':
+    convert(sys.argv[1], sys.argv[2])
@@ -0,0 +1,80 @@
+#!/usr/bin/python
+import os
+import struct
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from webdetect import BARRIER_BYTE, FastWebdetectClient, WebdetectClient, WebdetectLevelDb
+
+"""
+Fast detection (FastWebdetectClient) is compared with full detection over hosts where skipping the rest of
+an app directory could hide other app-versions: a plugin bundled in a theme directory, and other version of
+a plugin left in its directory which a checksum elsewhere depends-on.
+
+python3 -m unittest discover ./client/tests
+"""
+
+AV_ID = struct.Struct('>I')
+
+
+class HostBuilder:
+
+    def __init__(self):
+        self.db = {}
+        self.local = []
+
+    def app_version(self, av: int, app: str, version: str, total: int) -> bytes:
+        av_id = AV_ID.pack(av)
+        self.db[av_id] = ('%s\0%s\0\0' % (app, version)).encode('utf8') + bytes([total])
+        return av_id
+
+    def file(self, path: str, av_id: bytes, depends_on=()):
+        cs = struct.pack('>I', len(self.local)) * 8
+        self.db[cs] = av_id + b''.join(depends_on) + BARRIER_BYTE + b'\x01'
+        self.local.append((path.encode('utf8'), cs))
+
+    def detect(self, client_type):
+        client = client_type(get_by_key=self.db.get,
+                             parse_checksum_value=WebdetectLevelDb.parse_checksum_value,
+                             parse_app_version_value=WebdetectLevelDb.parse_app_version_value,
+                             local_checksums=sorted(self.local),
+                             checksums_bound=0.5)
+        return sorted(str(x) for x in client.process())
+
+
+class FastDetectionTest(unittest.TestCase):
+
+    def test_plugin_bundled_in_theme_directory(self):
+        host = HostBuilder()
+        theme = host.app_version(1, 'wp.tsometheme', '1.0', 20)
+        plugin = host.app_version(2, 'wp.prevslider', '4.0', 6)
+        for i in range(20):
+            host.file('/h/wp-content/themes/sometheme/a%02d.php' % i, theme)
+        for directory in ('admin', 'includes', 'public'):
+            for i in range(2):
+                host.file('/h/wp-content/themes/sometheme/vendor/revslider/%s/f%d.php' % (directory, i), plugin)
+
+        expected = host.detect(WebdetectClient)
+        self.assertEqual(expected, ['wp.prevslider 4.0', 'wp.tsometheme 1.0'])
+        self.assertEqual(host.detect(FastWebdetectClient), expected)
+
+    def test_depends_on_other_version_in_plugin_directory(self):
+        host = HostBuilder()
+        new = host.app_version(1, 'wp.pp', '2', 20)
+        old = host.app_version(2, 'wp.pp', '1', 20)
+        other = host.app_version(3, 'other', '1', 1)
+        for i in range(20):
+            host.file('/h/wp-content/plugins/p/a%02d' % i, new)
+        for i in range(12):
+            host.file('/h/wp-content/plugins/p/z%02d' % i, old)
+        host.file('/s/other/c', other, [old])
+
+        expected = host.detect(WebdetectClient)
+        self.assertEqual(expected, ['wp.pp 1', 'wp.pp 2'])
+        self.assertEqual(host.detect(FastWebdetectClient), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
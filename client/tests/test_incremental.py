@@ -0,0 +1,121 @@
+#!/usr/bin/python
+import os
+import random
+import struct
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from incremental import IncrementalWebdetect, webdetect_delta, webdetect_incremental_init
+from snapshot import write_snapshot
+from utils.rapidscan_writer import RapidscanFileWriter
+from webdetect import BARRIER_BYTE, WebdetectClient, WebdetectLevelDb
+
+"""
+Incremental re-detection is compared with full detection over the same rapidscan contents, after each of random
+deltas over random webdetect DBs (depends-on chains and cycles, implies).
+
+python3 -m unittest discover ./client/tests
+"""
+
+AV_ID = struct.Struct('>I')
+
+
+def random_db(rnd: random.Random, avs: int, checksums: int):
+    db = {}
+    for av in range(avs):
+        implies = b''.join(AV_ID.pack(x) for x in rnd.sample(range(avs), rnd.randint(0, 2)))
+        db[AV_ID.pack(av)] = b'app%d\0v\0\0' % av + bytes([rnd.randint(1, 4)]) + implies
+    all_checksums = []
+    for i in range(checksums):
+        cs = struct.pack('>I', i) * 8
+        depends_on = rnd.sample(range(avs), rnd.choice([0, 1, 1, 2]))
+        db[cs] = b''.join(AV_ID.pack(x) for x in [rnd.randrange(avs)] + depends_on) + BARRIER_BYTE + b'\x01'
+        all_checksums.append(cs)
+    return db, all_checksums
+
+
+def full_client(db, local):
+    return WebdetectClient(get_by_key=db.get,
+                           parse_checksum_value=WebdetectLevelDb.parse_checksum_value,
+                           parse_app_version_value=WebdetectLevelDb.parse_app_version_value,
+                           local_checksums=sorted(local),
+                           checksums_bound=0.5)
+
+
+class IncrementalTest(unittest.TestCase):
+
+    def test_random_deltas_match_full_recompute(self):
+        for seed in range(200):
+            rnd = random.Random(seed)
+            db, checksums = random_db(rnd, avs=rnd.randint(2, 8), checksums=rnd.randint(4, 30))
+            # absent checksums are looked up too
+            candidates = checksums + [b'\xff' * 32]
+            local = set((b'/%d/%s' % (rnd.randrange(3), cs.hex().encode()), cs)
+                        for cs in rnd.sample(candidates, rnd.randint(0, len(candidates))))
+
+            client = full_client(db, local)
+            client.process()
+            cs_keys = {}
+            for (k, cs) in local:
+                if cs in client.checksums_cache:
+                    cs_keys.setdefault(cs, set()).add(k)
+            incremental = IncrementalWebdetect(client, cs_keys)
+
+            for step in range(10):
+                removed = set(rnd.sample(sorted(local), rnd.randint(0, min(3, len(local)))))
+                added = set((b'/%d/%s' % (rnd.randrange(3), cs.hex().encode()), cs)
+                            for cs in rnd.sample(candidates, rnd.randint(0, 3))) - local
+                previous = set(incremental.client.matching_result)
+                detected, lost, _ = incremental.apply(db.get, WebdetectLevelDb.parse_checksum_value,
+                                                      WebdetectLevelDb.parse_app_version_value,
+                                                      sorted(added), sorted(removed))
+                local = (local - removed) | added
+
+                expected = full_client(db, local)
+                expected.process()
+                context = 'seed %d, step %d' % (seed, step)
+                self.assertEqual(set(expected.matching_result), incremental.client.matching_result, context)
+                self.assertEqual(set(id(x) for x in detected),
+                                 set(id(incremental.client.app_versions_cache[av])
+                                     for av in incremental.client.matching_result - previous), context)
+                self.assertEqual(len(lost), len(previous - incremental.client.matching_result), context)
+
+    def test_state_round_trip(self):
+        rnd = random.Random(0)
+        db, checksums = random_db(rnd, avs=4, checksums=10)
+        client = full_client(db, [(cs, cs) for cs in checksums])
+        client.process()
+        incremental = IncrementalWebdetect(client, {cs: {cs} for cs in client.checksums_cache})
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'state')
+            incremental.save(path)
+            incremental.save(path)
+            self.assertEqual(os.listdir(directory), ['state'])
+            loaded = IncrementalWebdetect.load(path)
+        self.assertEqual(loaded.client.matching_result, client.matching_result)
+
+    def test_delta_over_changed_db_is_refused(self):
+        rnd = random.Random(0)
+        db, checksums = random_db(rnd, avs=4, checksums=10)
+        with tempfile.TemporaryDirectory() as directory:
+            path_to_db = os.path.join(directory, 'webdetect.snapshot')
+            path_to_rapidscan = os.path.join(directory, 'rapidscan')
+            path_to_state = os.path.join(directory, 'state')
+            write_snapshot(sorted(db.items()), path_to_db, 'a' * 64)
+            writer = RapidscanFileWriter(path_to_rapidscan)
+            for cs in checksums:
+                writer.write(cs.hex(), b'/' + cs.hex().encode())
+            writer.close()
+            webdetect_incremental_init(path_to_db, path_to_rapidscan, path_to_state)
+            webdetect_delta(path_to_db, path_to_state, [], [])
+
+            write_snapshot(sorted(db.items()), path_to_db, 'b' * 64)
+            with self.assertRaisesRegex(Exception, 'webdetect_incremental_init is required'):
+                webdetect_delta(path_to_db, path_to_state, [], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,173 @@
+from __future__ import print_function
+
+"""
+Persistent cache of file SHA-256 checksums keyed by file stat, shared by scanner.py and path_scanner.py.
+
+Entry is keyed by (device, inode) and is valid while file size, mtime and ctime are the same, so unchanged files
+are answered by stat only, without being opened.
+
+File format: 8-byte header (magic + version), then fixed-size records
+<device, inode, size, mtime_ns, ctime_ns> as 64-bit integers followed by 32-byte raw digest, sorted by
+(device, inode) since version 2 (version 1 files are still loaded by HashCache).
+Entries which were not looked up during a run are dropped on save(prune=True).
+
+HashCache loads all entries into a dict. MappedHashCache is a read-only view of the file instead: records are
+found by binary search in mmap-ed file, so worker processes share its pages, and only checksums of new or changed
+files are kept in memory; they are written back by merge_entries, which streams existing records.
+"""
+
+import binascii
+import mmap
+import os
+import struct
+
+MAGIC = b'WDHC\x00\x00\x00\x02'
+UNSORTED_MAGIC = b'WDHC\x00\x00\x00\x01'
+RECORD = struct.Struct('<QQQqq32s')
+KEY = struct.Struct('<QQ')
+
+
+def stat_key(st):
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    ctime_ns = getattr(st, 'st_ctime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1e9)
+        ctime_ns = int(st.st_ctime * 1e9)
+    return (st.st_dev, st.st_ino), (st.st_size, mtime_ns, ctime_ns)
+
+
+class HashCache:
+
+    def __init__(self, path):
+        self.path = path
+        # (device, inode) -> (size, mtime_ns, ctime_ns, raw digest)
+        self.entries = {}
+        self.touched = set()
+        self.hits = 0
+        self.misses = 0
+        if os.path.exists(path):
+            self.load()
+
+    def load(self):
+        with open(self.path, 'rb') as f:
+            if f.read(len(MAGIC)) not in (MAGIC, UNSORTED_MAGIC):
+                return
+            while True:
+                record = f.read(RECORD.size)
+                if len(record) < RECORD.size:
+                    break
+                dev, ino, size, mtime_ns, ctime_ns, digest = RECORD.unpack(record)
+                self.entries[(dev, ino)] = (size, mtime_ns, ctime_ns, digest)
+
+    # returns hex SHA-256 of file at :path, :evaluate_hash(path) -> hex digest is called only for changed files
+    def hexdigest(self, path, evaluate_hash):
+        key, stamp = stat_key(os.stat(path))
+        self.touched.add(key)
+        entry = self.entries.get(key)
+        if entry is not None and entry[:3] == stamp:
+            self.hits += 1
+            return binascii.hexlify(entry[3]).decode('ascii')
+        self.misses += 1
+        hsh = evaluate_hash(path)
+        self.entries[key] = stamp + (binascii.unhexlify(hsh),)
+        return hsh
+
+    def save(self, prune=False):
+        write_records(self.path, (key + entry for key, entry in sorted(self.entries.items())
+                                  if not prune or key in self.touched))
+
+
+# private; writes :records (device, inode, size, mtime_ns, ctime_ns, raw digest), sorted by (device, inode)
+def write_records(path, records):
+    tmp_path = '%s.tmp.%d' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        for record in records:
+            f.write(RECORD.pack(*record))
+    os.rename(tmp_path, path)
+
+
+# rewrites cache file of version 1 with sorted records, so it can be read by MappedHashCache
+def sort_records(path):
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            unsorted = f.read(len(UNSORTED_MAGIC)) == UNSORTED_MAGIC
+        if unsorted:
+            HashCache(path).save()
+
+
+class MappedHashCache:
+    # same hexdigest as of HashCache; file of other version (or missing one) is considered empty
+
+    def __init__(self, path):
+        # (device, inode) -> (size, mtime_ns, ctime_ns, raw digest) of files which are not in the file or changed
+        self.new_entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.mm = None
+        self.count = 0
+        if os.path.exists(path) and os.path.getsize(path) > len(MAGIC):
+            with open(path, 'rb') as f:
+                if f.read(len(MAGIC)) == MAGIC:
+                    self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    self.count = (len(self.mm) - len(MAGIC)) // RECORD.size
+
+    # private
+    def record(self, index):
+        return RECORD.unpack_from(self.mm, len(MAGIC) + index * RECORD.size)
+
+    # private; (size, mtime_ns, ctime_ns, raw digest) of :key, None if there is no record of it
+    def find(self, key):
+        low = 0
+        high = self.count
+        while low < high:
+            middle = (low + high) // 2
+            middle_key = KEY.unpack_from(self.mm, len(MAGIC) + middle * RECORD.size)
+            if middle_key < key:
+                low = middle + 1
+            elif middle_key > key:
+                high = middle
+            else:
+                return self.record(middle)[2:]
+        return None
+
+    def hexdigest(self, path, evaluate_hash):
+        key, stamp = stat_key(os.stat(path))
+        entry = self.find(key)
+        if entry is not None and entry[:3] == stamp:
+            self.hits += 1
+            return binascii.hexlify(entry[3]).decode('ascii')
+        self.misses += 1
+        hsh = evaluate_hash(path)
+        self.new_entries[key] = stamp + (binascii.unhexlify(hsh),)
+        return hsh
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+
+
+# adds (or replaces) :new_entries, as MappedHashCache.new_entries, to cache file at :path; records of the file
+# are streamed, so memory is bounded by :new_entries
+def merge_entries(path, new_entries):
+    existing = MappedHashCache(path)
+    new_keys = sorted(new_entries.keys())
+
+    def records():
+        i = 0
+        for index in range(existing.count):
+            record = existing.record(index)
+            key = record[:2]
+            while i < len(new_keys) and new_keys[i] < key:
+                yield new_keys[i] + new_entries[new_keys[i]]
+                i += 1
+            if i < len(new_keys) and new_keys[i] == key:
+                continue
+            yield record
+        for key in new_keys[i:]:
+            yield key + new_entries[key]
+
+    try:
+        write_records(path, records())
+    finally:
+        existing.close()
@@ -6,21 +6,45 @@ This script collects all checksums and their paths for given directory.
 
 It's supposed to be run client's server, so there are commented sections to ensure that this script starts
 only on selected time and runs only if LA is higher than some constant.
+
+Concurrent mode (any of options below) hashes files with a pool of threads and throttles itself:
+- -j/--jobs, --block-size - workers count and read size
+- --max-load - workers pause while 1-minute load average is at least this value
+- --max-rate - read rate budget (bytes/s), scaled down proportionally as load average approaches --max-load
+- --nice, --ionice-idle - lowers CPU and I/O priority of the scan
+- -o/--output with --checkpoint - output is written to file and progress (completed directories) to checkpoint,
+  so interrupted scan started again with the same options continues where it stopped
+Output format is the same: <sha256>\t<path> lines, in os.walk order of (sorted) directories.
+
+Instead of text, results can be written with raw digests directly in formats read by webdetect.py
+(see rapidscan_writer.py): --rapidscan-db (LevelDB, can be combined with --checkpoint) or --rapidscan-file.
 """
 
+import argparse
 import datetime
 import hashlib
 import os
+import struct
+import subprocess
 import sys
+import threading
 import time
 import traceback
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+from hash_cache import HashCache
+from rapidscan_writer import RapidscanFileWriter, RapidscanLevelDbWriter
 
 BLOCK_SIZE = 4 * (2 ** 10)
+# checkpoint record: output offset, length of directory path which follows the record
+CHECKPOINT_RECORD = struct.Struct('<QI')
 # HOUR_TO_START = 1
 # LOAD_AVERAGE_MAXIMUM = 15
 
 
-def scan_for_cs(path):
+# :writer - optional RapidscanLevelDbWriter/RapidscanFileWriter used instead of printing
+def scan_for_cs(path, hash_cache=None, writer=None):
     for root, dirs, files in os.walk(path):
         for file_name in files:
             # try:
@@ -32,8 +56,14 @@ def scan_for_cs(path):
             #     pass
             try:
                 path = os.path.join(root, file_name)
-                hsh = evaluate_hash(path)
-                print('%s\t%s' % (hsh, path))
+                if hash_cache is None:
+                    hsh = evaluate_hash(path)
+                else:
+                    hsh = hash_cache.hexdigest(path, evaluate_hash)
+                if writer is None:
+                    print('%s\t%s' % (hsh, path))
+                else:
+                    writer.write(hsh, to_bytes(path))
             except:
                 print(datetime.datetime.utcnow())
                 for e in sys.exc_info():
@@ -42,16 +72,237 @@ def scan_for_cs(path):
                 sys.stderr.flush()
 
 
-def evaluate_hash(path):
+def evaluate_hash(path, block_size=BLOCK_SIZE, throttle=None):
     sha256_hash = hashlib.sha256()
     with open(path, 'rb') as f:
-        for byte_block in iter(lambda: f.read(BLOCK_SIZE), b""):
+        for byte_block in iter(lambda: f.read(block_size), b""):
+            if throttle is not None:
+                throttle.consume(len(byte_block))
             sha256_hash.update(byte_block)
         return sha256_hash.hexdigest()
 
 
+LOAD_CHECK_INTERVAL = 60
+MIN_RATE_FACTOR = 0.1
+
+
+class Throttle:
+    def __init__(self, max_load=None, max_rate=None):
+        self.max_load = max_load
+        self.max_rate = max_rate
+        self.lock = threading.Lock()
+        self.next_read = time.time()
+        self.load = 0.0
+        self.load_checked = 0.0
+
+    def current_load(self):
+        now = time.time()
+        if now - self.load_checked >= 1:
+            self.load_checked = now
+            try:
+                self.load = os.getloadavg()[0]
+            except OSError:
+                self.load = 0.0
+        return self.load
+
+    # blocks while load average is too high
+    def wait_for_load(self):
+        if self.max_load is None:
+            return
+        while self.current_load() >= self.max_load:
+            print("%s load average >= %s: %s" % (str(datetime.datetime.now()), self.max_load, str(os.getloadavg())),
+                  file=sys.stderr)
+            time.sleep(LOAD_CHECK_INTERVAL)
+            self.load_checked = 0.0
+
+    # accounts :size read bytes in rate budget, sleeping if budget is exceeded
+    def consume(self, size):
+        if self.max_rate is None:
+            return
+        rate = self.max_rate
+        if self.max_load is not None:
+            rate *= max(MIN_RATE_FACTOR, 1.0 - self.current_load() / self.max_load)
+        with self.lock:
+            now = time.time()
+            self.next_read = max(self.next_read, now) + float(size) / rate
+            delay = self.next_read - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+def lower_priority(nice, ionice_idle):
+    if nice:
+        os.nice(nice)
+    if ionice_idle:
+        try:
+            subprocess.call(['ionice', '-c', '3', '-p', str(os.getpid())])
+        except OSError:
+            print('ionice is not available', file=sys.stderr)
+
+
+class Checkpoint:
+    # progress file is a sequence of CHECKPOINT_RECORD, each followed by <directory> (so any bytes are allowed in it):
+    # all files of <directory> are written before <offset>; record which was being written when scan was interrupted
+    # is dropped; with :writer instead of :output_path, offsets are 0 and writer is flushed after each completed
+    # directory (rapidscan LevelDB puts are idempotent, so files of partially completed directory are written again)
+
+    def __init__(self, path, output_path=None, writer=None):
+        self.writer = writer
+        self.output = None
+        self.done = set()
+        offset = 0
+        size = 0
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                data = f.read()
+            while size + CHECKPOINT_RECORD.size <= len(data):
+                (record_offset, length) = CHECKPOINT_RECORD.unpack_from(data, size)
+                end = size + CHECKPOINT_RECORD.size + length
+                if end > len(data):
+                    break
+                offset = record_offset
+                self.done.add(data[size + CHECKPOINT_RECORD.size:end])
+                size = end
+            if size < len(data):
+                with open(path, 'ab') as f:
+                    f.truncate(size)
+        if output_path is not None:
+            self.output = open(output_path, 'ab')
+            self.output.truncate(offset)
+            self.output.seek(offset)
+        self.file = open(path, 'ab')
+
+    def is_done(self, directory):
+        return to_bytes(directory) in self.done
+
+    def complete(self, directory):
+        offset = 0
+        if self.output is not None:
+            self.output.flush()
+            offset = self.output.tell()
+        if self.writer is not None:
+            self.writer.flush()
+        directory = to_bytes(directory)
+        self.file.write(CHECKPOINT_RECORD.pack(offset, len(directory)) + directory)
+        self.file.flush()
+
+    def close(self):
+        if self.output is not None:
+            self.output.close()
+        self.file.close()
+
+
+def to_bytes(string):
+    if isinstance(string, bytes):
+        return string
+    return string.encode('utf-8', 'surrogateescape')
+
+
+def scan_for_cs_concurrently(path, jobs, block_size=BLOCK_SIZE, throttle=None, hash_cache=None, checkpoint=None,
+                             writer=None):
+    def hash_file(file_path):
+        if throttle is not None:
+            throttle.wait_for_load()
+        if hash_cache is None:
+            return evaluate_hash(file_path, block_size, throttle)
+        return hash_cache.hexdigest(file_path, lambda p: evaluate_hash(p, block_size, throttle))
+
+    def write(hsh, file_path):
+        if writer is not None:
+            writer.write(hsh, to_bytes(file_path))
+        elif checkpoint is None:
+            print('%s\t%s' % (hsh, file_path))
+        else:
+            checkpoint.output.write(to_bytes('%s\t%s\n' % (hsh, file_path)))
+
+    # (file path, result) or (directory, None) when all files of directory are submitted
+    pending = deque()
+    in_flight_limit = jobs * 16
+
+    def drain(everything):
+        while pending and (everything or len(pending) > in_flight_limit or
+                           pending[0][1] is None or pending[0][1].ready()):
+            name, result = pending.popleft()
+            if result is None:
+                if checkpoint is not None:
+                    checkpoint.complete(name)
+                continue
+            try:
+                write(result.get(), name)
+            except:
+                print(datetime.datetime.utcnow(), file=sys.stderr)
+                traceback.print_exc(file=sys.stderr)
+                sys.stderr.flush()
+
+    pool = ThreadPool(jobs)
+    try:
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            if checkpoint is not None and checkpoint.is_done(root):
+                continue
+            for file_name in sorted(files):
+                file_path = os.path.join(root, file_name)
+                pending.append((file_path, pool.apply_async(hash_file, (file_path,))))
+                drain(False)
+            pending.append((root, None))
+            drain(False)
+        drain(True)
+    finally:
+        pool.terminate()
+
+
 if __name__ == '__main__':
     # while not datetime.datetime.now().hour == HOUR_TO_START:
     #     print("time().hour != 1: %s" % str(datetime.datetime.now()), file=sys.stderr)
     #     time.sleep(60)
-    scan_for_cs(sys.argv[1])
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path')
+    # path to hash cache (see hash_cache.py) kept between runs
+    parser.add_argument('hash_cache', nargs='?')
+    parser.add_argument('-j', '--jobs', type=int)
+    parser.add_argument('--block-size', type=int, default=BLOCK_SIZE)
+    parser.add_argument('--max-load', type=float)
+    parser.add_argument('--max-rate', type=float)
+    parser.add_argument('--nice', type=int, default=0)
+    parser.add_argument('--ionice-idle', action='store_true')
+    parser.add_argument('-o', '--output')
+    parser.add_argument('--checkpoint')
+    parser.add_argument('--rapidscan-db')
+    parser.add_argument('--rapidscan-file')
+    args = parser.parse_args()
+    if len([x for x in (args.output, args.rapidscan_db, args.rapidscan_file) if x is not None]) > 1:
+        parser.error('only one of --output, --rapidscan-db, --rapidscan-file can be used')
+    if args.checkpoint is not None and args.output is None and args.rapidscan_db is None:
+        parser.error('--checkpoint requires --output or --rapidscan-db')
+
+    cache = HashCache(args.hash_cache) if args.hash_cache is not None else None
+    rapidscan_writer = None
+    if args.rapidscan_db is not None:
+        rapidscan_writer = RapidscanLevelDbWriter(args.rapidscan_db)
+    elif args.rapidscan_file is not None:
+        rapidscan_writer = RapidscanFileWriter(args.rapidscan_file)
+    concurrent = args.jobs is not None or args.block_size != BLOCK_SIZE or args.max_load is not None or \
+        args.max_rate is not None or args.nice or args.ionice_idle or args.output is not None or \
+        args.checkpoint is not None
+    try:
+        if not concurrent:
+            scan_for_cs(args.path, cache, rapidscan_writer)
+        else:
+            lower_priority(args.nice, args.ionice_idle)
+            checkpoint = None
+            if args.output is not None:
+                checkpoint = Checkpoint(args.checkpoint or os.devnull, output_path=args.output)
+            elif args.checkpoint is not None:
+                checkpoint = Checkpoint(args.checkpoint, writer=rapidscan_writer)
+            try:
+                scan_for_cs_concurrently(args.path, args.jobs or 1, args.block_size,
+                                         Throttle(args.max_load, args.max_rate), cache, checkpoint, rapidscan_writer)
+            finally:
+                if checkpoint is not None:
+                    checkpoint.close()
+    finally:
+        if rapidscan_writer is not None:
+            rapidscan_writer.close()
+        if cache is not None:
+            # resumed scan does not look up files of completed directories, their entries are kept
+            cache.save(prune=args.checkpoint is None)
@@ -0,0 +1,71 @@
+from __future__ import print_function
+
+"""
+Writers of path_scanner.py results in formats read by webdetect.py directly, without <sha256>\t<path> text:
+- rapidscan LevelDB: key is file path, value is RAPIDSCAN_HEADER followed by 32-byte raw SHA-256
+  (webdetect() reads checksum as v[9:][:32]); requires plyvel
+- rapidscan file: MAGIC, then records <32-byte raw SHA-256><4-byte little-endian path length><path>
+"""
+
+import binascii
+import struct
+
+RAPIDSCAN_HEADER = b'\x00' * 9
+MAGIC = b'WDRS\x00\x00\x00\x01'
+PATH_LENGTH = struct.Struct('<I')
+DIGEST_SIZE = 32
+BATCH_SIZE = 10000
+
+
+class RapidscanLevelDbWriter:
+
+    def __init__(self, path, batch_size=BATCH_SIZE):
+        import plyvel
+        self.db = plyvel.DB(path, create_if_missing=True)
+        self.batch_size = batch_size
+        self.batch = self.db.write_batch()
+        self.batched = 0
+
+    def write(self, hsh, path):
+        self.batch.put(path, RAPIDSCAN_HEADER + binascii.unhexlify(hsh))
+        self.batched += 1
+        if self.batched >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        self.batch.write()
+        self.batch = self.db.write_batch()
+        self.batched = 0
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+
+class RapidscanFileWriter:
+
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+
+    def write(self, hsh, path):
+        self.file.write(binascii.unhexlify(hsh) + PATH_LENGTH.pack(len(path)) + path)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+# yields (path, value) pairs of rapidscan file in the same layout as rapidscan LevelDB entries
+def read_rapidscan_file(path):
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise Exception("%s is not a rapidscan file" % path)
+        while True:
+            digest = f.read(DIGEST_SIZE + PATH_LENGTH.size)
+            if len(digest) < DIGEST_SIZE + PATH_LENGTH.size:
+                return
+            (length,) = PATH_LENGTH.unpack(digest[DIGEST_SIZE:])
+            yield f.read(length), RAPIDSCAN_HEADER + digest[:DIGEST_SIZE]
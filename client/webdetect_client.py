@@ -1,41 +1,18 @@
-import json
+import os
 import sys
-from typing import Optional, Tuple, List, Dict
+from typing import List, Dict
 
-from webdetect import AppVersionEntry, WebdetectClient, WebdetectLevelDb
-
-
-class WebdetectJsonDb:
-    # impl for JSON DB version for local debugging
-
-    def __init__(self, path_to_db: str):
-        with open(path_to_db, mode='r') as file_db:
-            self.db = json.load(file_db)
-
-    def get_by_key(self, key: bytes) -> Optional[bytes]:
-        k = str(key)
-        if k in self.db:
-            return self.db[k]
-        else:
-            return None
-
-    # checksums are valued with an array of 32-bit integers; format:
-    # [app-version id for this checksum, ...app-versions on which checksum 'depends-on', barrier, ...depth levels]
-    # noinspection PyTypeChecker
-    @staticmethod
-    def parse_checksum_value(value: bytes) -> Tuple[bytes, List[bytes], List[bytes]]:
-        barrier = value.index(-1)
-        return value[0], value[1:barrier], value[barrier + 1:]
-
-    # app-version ids are valued with string containing AppVersionEntry in json q
-    @staticmethod
-    def parse_app_version_value(value: bytes) -> AppVersionEntry:
-        parsed = value
-        return AppVersionEntry(parsed)
+from json_db import WebdetectJsonDb, is_json_db
+from utils.rapidscan_writer import MAGIC as RAPIDSCAN_MAGIC
+from webdetect import AppVersionEntry, WebdetectClient, open_webdetect_db, rapidscan_db_to_structure
 
 
+# :path_to_webdetect_leveldb - webdetect LevelDB, its snapshot or JSON/NDJSON dump (see json_db.py)
 def lookup_json(path_to_webdetect_leveldb: str, checksums: Dict[str, List[str]]):
-    wd_db = WebdetectLevelDb(path_to_webdetect_leveldb)
+    if is_json_db(path_to_webdetect_leveldb):
+        wd_db = WebdetectJsonDb(path_to_webdetect_leveldb)
+    else:
+        wd_db = open_webdetect_db(path_to_webdetect_leveldb)
     wc = WebdetectClient(get_by_key=wd_db.get_by_key,
                          parse_checksum_value=wd_db.parse_checksum_value,
                          parse_app_version_value=wd_db.parse_app_version_value,
@@ -54,17 +31,36 @@ def lookup_json(path_to_webdetect_leveldb: str, checksums: Dict[str, List[str]])
         for path in paths:
             to_be_layered.append((av, path))
 
-    structure = WebdetectClient.find_structure(to_be_layered)
+    print_structure(WebdetectClient.find_structure(to_be_layered))
+
+
+# same as lookup_json, but for rapidscan LevelDB or file written by path_scanner.py, without hex decoding
+def lookup_rapidscan(path_to_webdetect_leveldb: str, path_to_rapidscan: str):
+    print_structure(rapidscan_db_to_structure(path_to_webdetect_leveldb, path_to_rapidscan))
+
+
+def print_structure(structure):
     for (av, path), children in structure.items():
         print("%s at %s" % (av, path))
         for (dep_av, dep_path) in children:
             print("\t%s at %s" % (dep_av, dep_path))
 
 
+def is_rapidscan(path: str) -> bool:
+    if os.path.isdir(path):
+        return True
+    with open(path, mode='rb') as f:
+        return f.read(len(RAPIDSCAN_MAGIC)) == RAPIDSCAN_MAGIC
+
+
 """
 sys.argv[1] format is (<sha256 checksum>\t<path to file>\n)+ 
+or rapidscan LevelDB/file written by path_scanner.py (--rapidscan-db/--rapidscan-file)
 """
 if __name__ == '__main__':
+    if is_rapidscan(sys.argv[1]):
+        lookup_rapidscan(path_to_webdetect_leveldb=sys.argv[2], path_to_rapidscan=sys.argv[1])
+        sys.exit(0)
     # print(sys.argv[1])
     css: Dict[str, List[str]] = {}
     with open(sys.argv[1], mode='rb') as db:
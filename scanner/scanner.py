@@ -1,15 +1,70 @@
 #!/usr/bin/python
 import csv
 import hashlib
+import mmap
+import multiprocessing
 import os
+import struct
 import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'client', 'utils'))
+
+from hash_cache import HashCache, MappedHashCache, merge_entries, sort_records
+from whitelist_format import WhitelistWriter, encode_blocks, is_whitelist, read_rows
 
 idx = 1
+# optional HashCache, set by main
+hash_cache = None
 
 IGNORED_DIRECTORIES = {'.git', '.svn'}
 
 
-def walk(version_root, app, version):
+class TsvOutput:
+    # app\tversion\thash\tdepth lines on stdout
+
+    def write(self, app, version, hsh, depth):
+        print('%s\t%s\t%s\t%s' % (app, version, hsh, depth))
+
+    def close(self):
+        pass
+
+
+# TsvOutput or WhitelistWriter (see whitelist_format.py), set by main
+output = TsvOutput()
+# whether worker processes of manifest scan produce binary whitelist blocks, set by init_worker
+binary_output = False
+
+
+class OrderedHashPool:
+    # hashes files with a pool of threads (hashlib releases GIL while hashing), but prints lines in submission order,
+    # so output is the same as for sequential walk; at most :queue_size files are in flight
+
+    def __init__(self, jobs):
+        self.executor = ThreadPoolExecutor(max_workers=jobs)
+        self.pending = deque()
+        self.queue_size = jobs * 16
+
+    def submit(self, file_path, app, version, depth):
+        self.pending.append((self.executor.submit(file_hash, file_path), app, version, depth))
+        while len(self.pending) > self.queue_size or (self.pending and self.pending[0][0].done()):
+            self.print_first()
+
+    def print_first(self):
+        future, app, version, depth = self.pending.popleft()
+        try:
+            output.write(app, version, future.result(), depth)
+        except:
+            print('err: %s' % str(sys.exc_info()), file=sys.stderr)
+
+    def close(self):
+        while self.pending:
+            self.print_first()
+        self.executor.shutdown()
+
+
+def walk(version_root, app, version, pool=None):
     if type(version) == type(bytes):
         version = version.decode("utf8")
     if version in IGNORED_DIRECTORIES:
@@ -17,32 +72,53 @@ def walk(version_root, app, version):
     global idx
     print('av %d %s' % (idx, version_root), file=sys.stderr)
     idx += 1
+    for file_path, depth in unit_files(version_root):
+        if pool is not None:
+            pool.submit(file_path, app, version, depth)
+            continue
+        try:
+            hsh = file_hash(file_path)
+            # print('%s\t%s\t%s\t%s\t%s' % (
+            #     app, version, hsh, depth, file_path))
+            output.write(app, version, hsh, depth)
+        except:
+            print('err: %s' % str(sys.exc_info()), file=sys.stderr)
+
+
+# (path, depth) of each file of app-version at :version_root
+def unit_files(version_root):
     for root, d_names, f_names in os.walk(version_root):
         for ignored_directory in IGNORED_DIRECTORIES:
             if ignored_directory in d_names:
                 d_names.remove(ignored_directory)
         for f in f_names:
-            try:
-                file_path = os.path.join(root, f)
-                hsh = sha256_f(file_path)
-                # print('%s\t%s\t%s\t%s\t%s' % (
-                #     app, version, hsh, remove_prefix(file_path, version_root).count('/'), file_path))
-                print('%s\t%s\t%s\t%s' % (app, version, hsh, remove_prefix(file_path, version_root).count('/')))
-            except:
-                print('err: %s' % str(sys.exc_info()), file=sys.stderr)
+            file_path = os.path.join(root, f)
+            yield file_path, remove_prefix(file_path, version_root).count('/')
 
 
 BLOCK_SIZE = 16 * (2 ** 10)
+# files of at least this size are hashed via mmap in one hashlib call
+MMAP_THRESHOLD = 2 ** 20
 
 
 def sha256_f(path):
     sha256_hash = hashlib.sha256()
     with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size >= MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                sha256_hash.update(mm)
+            return sha256_hash.hexdigest()
         for byte_block in iter(lambda: f.read(BLOCK_SIZE), b""):
             sha256_hash.update(byte_block)
         return sha256_hash.hexdigest()
 
 
+def file_hash(path):
+    if hash_cache is None:
+        return sha256_f(path)
+    return hash_cache.hexdigest(path, sha256_f)
+
+
 def remove_prefix(string, prefix):
     return string[len(prefix):] if string.startswith(prefix) else string
 
@@ -51,47 +127,215 @@ def subdirectories(path):
     return [(x, os.path.join(path, x)) for x in os.listdir(path) if os.path.isdir(os.path.join(path, x))]
 
 
-def main(root, db):
+# :binary - whitelist_format.py output on stdout instead of TSV lines
+def main(root, db, jobs=1, cache_path=None, binary=False):
+    global hash_cache, output
+    if cache_path is not None:
+        hash_cache = HashCache(cache_path)
+    if binary:
+        output = WhitelistWriter(sys.stdout.buffer)
+    pool = OrderedHashPool(jobs) if jobs > 1 else None
+    try:
+        scan(root, db, pool)
+    finally:
+        if pool is not None:
+            pool.close()
+        output.close()
+        if hash_cache is not None:
+            # when resuming, skipped app-versions are not looked up, so their entries are kept
+            hash_cache.save(prune=db is None)
+            print('hash cache: %d hits, %d misses' % (hash_cache.hits, hash_cache.misses), file=sys.stderr)
+
+
+def scan(root, db, pool):
     already_parsed_avs = set()
-    if db is not None:
+    if db is not None and is_whitelist(db):
+        with open(db, 'rb') as db_file:
+            for row in read_rows(db_file):
+                already_parsed_avs.add((row[0], row[1]))
+    elif db is not None:
         with open(db, 'r') as db_file:
             for row in csv.reader(db_file, delimiter='\t'):
                 already_parsed_avs.add((row[0], row[1]))
 
-    def filtered_walk(vp, a, v):
-        if not ((a, v) in already_parsed_avs):
-            walk(vp, a, v)
+    for (app, version, version_path) in units(root):
+        if not ((app, version) in already_parsed_avs):
+            walk(version_path, app, version, pool)
+
 
+# (app, version, path) of each app-version directory of repository at :root, in scan order
+def units(root):
     for (directory, path) in subdirectories(root):
         app = directory
         if app.endswith('-cores'):
             for (version, version_path) in subdirectories(path):
-                filtered_walk(version_path, app, version)
+                yield app, version, version_path
         elif app.endswith('-themes'):
             for (app, app_path) in subdirectories(path):
                 app = 'wp.t' + app
                 for (version, version_path) in subdirectories(app_path):
-                    filtered_walk(version_path, app, version)
+                    yield app, version, version_path
         elif app.endswith('-plugins'):
             for (app, app_path) in subdirectories(path):
                 app = 'wp.p' + app
                 trunk_path = os.path.join(app_path, 'trunk')
                 tags_path = os.path.join(app_path, 'tags')
                 if os.path.isdir(trunk_path):
-                    filtered_walk(trunk_path, app, 'trunk')
+                    yield app, 'trunk', trunk_path
                 if os.path.isdir(tags_path):
                     for (version, version_path) in subdirectories(tags_path):
-                        filtered_walk(version_path, app, version)
+                        yield app, version, version_path
         # local testing only branch!
         # else:
         #     for (version, version_path) in subdirectories(path):
-        #         filtered_walk(version_path, app, version)
+        #         yield app, version, version_path
+
+
+# Manifest mode (-m <work dir>): all (app, version, path) units are enumerated once into <work dir>/manifest
+# and hashed by a pool of worker processes, one unit per task. Parent appends output lines of each completed unit
+# to <work dir>/whitelist.csv (or whitelist.bin, see whitelist_format.py) with a single write and then records it in <work dir>/progress, so restart
+# reads only the manifest and the progress file instead of previous output, and skips completed units.
+MANIFEST_NAME = 'manifest'
+PROGRESS_NAME = 'progress'
+OUTPUT_NAME = 'whitelist.csv'
+BINARY_OUTPUT_NAME = 'whitelist.bin'
+# index of completed unit in manifest, output size after its lines
+PROGRESS_RECORD = struct.Struct('<IQ')
+# manifest is a sequence of units, each is app, version and path; each of them is MANIFEST_FIELD (length)
+# followed by utf-8 bytes, so names with any characters (i.e. tabs or newlines) are read back as they were
+MANIFEST_FIELD = struct.Struct('<I')
+
+
+# manifest is written once (atomically) and reused on restarts, even if repository has changed since then
+def load_manifest(root, work_dir):
+    path = os.path.join(work_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            for unit in units(root):
+                for field in unit:
+                    encoded = field.encode('utf8', 'surrogateescape')
+                    f.write(MANIFEST_FIELD.pack(len(encoded)) + encoded)
+        os.replace(tmp_path, path)
+    with open(path, 'rb') as f:
+        data = f.read()
+    fields = []
+    position = 0
+    while position < len(data):
+        (length,) = MANIFEST_FIELD.unpack_from(data, position)
+        position += MANIFEST_FIELD.size
+        fields.append(data[position:position + length].decode('utf8', 'surrogateescape'))
+        position += length
+    return [tuple(fields[i:i + 3]) for i in range(0, len(fields), 3)]
+
+
+class Progress:
+    # progress file is a sequence of PROGRESS_RECORD; output is truncated on open to the size recorded last,
+    # so lines of a unit which was being written when scan was interrupted are dropped, and the unit is scanned again
+
+    def __init__(self, path, output_path):
+        self.done = set()
+        offset = 0
+        size = 0
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                data = f.read()
+            size = len(data) - len(data) % PROGRESS_RECORD.size
+            for (index, offset) in PROGRESS_RECORD.iter_unpack(data[:size]):
+                self.done.add(index)
+        self.file = open(path, 'ab')
+        self.file.truncate(size)
+        self.output = open(output_path, 'ab')
+        self.output.truncate(offset)
+        self.output.seek(offset)
+
+    def complete(self, index, lines):
+        self.output.write(lines)
+        self.output.flush()
+        self.file.write(PROGRESS_RECORD.pack(index, self.output.tell()))
+        self.file.flush()
+
+    def close(self):
+        self.output.close()
+        self.file.close()
+
+
+# workers share the cache file by mmap instead of loading it (see MappedHashCache)
+def init_worker(cache_path, binary):
+    global hash_cache, binary_output
+    hash_cache = MappedHashCache(cache_path) if cache_path is not None else None
+    binary_output = binary
+
+
+# runs in worker process; returns output of unit (TSV lines or whitelist blocks) and hash cache entries of its new
+# or changed files
+def scan_unit(task):
+    index, (app, version, version_root) = task
+    rows = []
+    if version not in IGNORED_DIRECTORIES:
+        for file_path, depth in unit_files(version_root):
+            try:
+                rows.append((app, version, file_hash(file_path), depth))
+            except:
+                print('err: %s' % str(sys.exc_info()), file=sys.stderr)
+    entries = {}
+    if hash_cache is not None:
+        entries = hash_cache.new_entries
+        hash_cache.new_entries = {}
+    if binary_output:
+        return index, encode_blocks(rows), entries
+    return index, ''.join('%s\t%s\t%s\t%s\n' % row for row in rows).encode('utf8', 'surrogateescape'), entries
+
+
+def scan_manifest(root, work_dir, jobs, cache_path=None, binary=False):
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+    manifest = load_manifest(root, work_dir)
+    progress = Progress(os.path.join(work_dir, PROGRESS_NAME),
+                        os.path.join(work_dir, BINARY_OUTPUT_NAME if binary else OUTPUT_NAME))
+    # only new entries are kept, they are merged into the cache file at the end
+    new_entries = {}
+    if cache_path is not None:
+        sort_records(cache_path)
+    tasks = [(index, unit) for (index, unit) in enumerate(manifest) if index not in progress.done]
+    print('units: %d, completed: %d' % (len(manifest), len(manifest) - len(tasks)), file=sys.stderr)
+    try:
+        with multiprocessing.Pool(jobs, initializer=init_worker, initargs=(cache_path, binary)) as pool:
+            for (index, lines, entries) in pool.imap_unordered(scan_unit, tasks):
+                progress.complete(index, lines)
+                new_entries.update(entries)
+                print('av %d %s' % (index + 1, manifest[index][2]), file=sys.stderr)
+    finally:
+        progress.close()
+        if cache_path is not None:
+            # entries of files which were not looked up (i.e. of units completed by previous runs) are kept
+            merge_entries(cache_path, new_entries)
 
 
 if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        print('scanner.py path_to_scan [already_scanned_av_csv]', file=sys.stderr)
-    elif len(sys.argv) == 2:
-        main(sys.argv[1], None)
-    elif len(sys.argv) > 2:
-        main(sys.argv[1], sys.argv[2])
+    args = sys.argv[1:]
+    jobs = None
+    cache = None
+    work_dir = None
+    binary = False
+    while len(args) > 1 and args[0] in ('-j', '-c', '-m', '-b'):
+        if args[0] == '-b':
+            binary = True
+            args = args[1:]
+            continue
+        if args[0] == '-j':
+            jobs = int(args[1])
+        elif args[0] == '-c':
+            cache = args[1]
+        else:
+            work_dir = args[1]
+        args = args[2:]
+    if len(args) < 1:
+        print('scanner.py [-j jobs] [-c hash_cache] [-m work_dir] [-b] path_to_scan [already_scanned_av_csv]',
+              file=sys.stderr)
+    elif work_dir is not None:
+        scan_manifest(args[0], work_dir, jobs or os.cpu_count(), cache, binary)
+    elif len(args) == 1:
+        main(args[0], None, jobs or 1, cache, binary)
+    elif len(args) > 1:
+        main(args[0], args[1], jobs or 1, cache, binary)